@@ -1,111 +1,164 @@
 #!/usr/bin/python
 
 import argparse
-import re
+import ftrace
+from histogram import LogHistogram
+
+NSECS_IN_SEC = float(ftrace.NSECS_IN_SEC)
 
 class Type:
     Data, Metadata, System = range(3)
+    names = ["Data", "Metadata", "System"]
 
 class Allocation:
     def __init__(self):
         self.process = ""
         self.cpu = 0
         self.root = ""
-        self.start_time = 0.0
+        self.len = 0
+        self.start_time = 0
         self.type = None
 
-parser = argparse.ArgumentParser(description="Get timing info out of an " +
-                                    "allocator trace")
-parser.add_argument('infile', metavar='file', help='Trace file to process')
-
-args = parser.parse_args()
-
-infile = open(args.infile, "r")
-
-header_re = re.compile("\s+(.*\d+)\s+\[(\d+)\]\s+(\d+\.\d+): .*")
-find_re = re.compile(".*find_free_extent: root = (\d+\(.*\)), len = (\d+)," +
-                     " empty_size = (\d+), flags = (\d+)\((.*)\)")
-reserve_re = re.compile(".*btrfs_reserve_extent:.*")
-
-state_dict = {}
-meta_times = []
-data_times = []
-system_times = []
-
-for line in infile:
-    m = header_re.match(line)
-    if not m:
-        print("That didnt work, m is " + m)
-        continue
-
-    process = m.group(1)
-    cpu = int(m.group(2))
-    time = float(m.group(3))
-
-    m = find_re.match(line)
-    if m:
+def size_class(size):
+    # Round up to the next power of two
+    cls = 1
+    while cls < size:
+        cls <<= 1
+    return cls
+
+def task_key(pid, cpu):
+    # Tasks can move cpus in the middle of an allocation, so match them up by
+    # pid.  The idle tasks all share pid 0 so those have to go by cpu.
+    if pid == 0:
+        return (pid, cpu)
+    return pid
+
+def expire(state_dict, before):
+    expired = 0
+    for key in list(state_dict.keys()):
+        stack = state_dict[key]
+        while stack and stack[0].start_time < before:
+            stack.pop(0)
+            expired += 1
+        if not stack:
+            del state_dict[key]
+    return expired
+
+def record(breakdown, key, value):
+    if key not in breakdown:
+        breakdown[key] = LogHistogram()
+    breakdown[key].record(value)
+
+def report(title, breakdown, label="%s"):
+    print(title)
+    for key in sorted(breakdown.keys()):
+        for line in breakdown[key].report(label % key, scale=NSECS_IN_SEC):
+            print("\t" + line)
+
+class AllocatorAnalyzer:
+    name = "Allocator timing"
+
+    def __init__(self, max_age=10.0):
+        self.parsers = { "find_free_extent": ftrace.parse_find_free_extent,
+                         "btrfs_reserve_extent": None,
+                       }
+        self.handlers = { "find_free_extent": self.find_free_extent,
+                          "btrfs_reserve_extent": self.reserve_extent,
+                        }
+
+        # Each task has a stack of the allocations it has in flight, the most
+        # recent find_free_extent is the one the next btrfs_reserve_extent
+        # ends
+        self.state_dict = {}
+        self.unmatched = 0
+        self.abandoned = 0
+        self.untyped = 0
+        self.max_age = int(max_age * ftrace.NSECS_IN_SEC)
+        self.next_expire = 0
+
+        # Allocation times in nanoseconds, broken down a few different ways
+        self.by_type = {}
+        self.by_root = {}
+        self.by_cpu = {}
+        self.by_size = {}
+
+    def expire(self, ts):
+        # Lost events leave allocations that will never finish, drop them
+        # every so often so they don't pile up
+        if ts >= self.next_expire:
+            self.abandoned += expire(self.state_dict, ts - self.max_age)
+            self.next_expire = ts + self.max_age
+
+    def find_free_extent(self, ev):
+        self.expire(ev.ts)
+        flags = ev.fields["flags"]
         alloc = Allocation()
-        alloc.process = process
-        alloc.cpu = cpu
-        alloc.root = m.group(1)
-        alloc.start_time = time
-        if "METADATA" in m.group(5):
+        alloc.process = ev.process
+        alloc.cpu = ev.cpu
+        alloc.root = ev.fields["root"]
+        alloc.len = ev.fields["len"]
+        alloc.start_time = ev.ts
+        if flags & ftrace.BLOCK_GROUP_METADATA:
             alloc.type = Type.Metadata
-        elif "DATA" in m.group(5):
+        elif flags & ftrace.BLOCK_GROUP_DATA:
             alloc.type = Type.Data
-        elif "SYSTEM" in m.group(5):
+        elif flags & ftrace.BLOCK_GROUP_SYSTEM:
             alloc.type = Type.System
 
-        state_dict[process] = alloc
-        continue
-
-    m = reserve_re.match(line)
-    if m:
-        if process in state_dict:
-            a = state_dict[process]
-            del state_dict[process]
-            run_time = time - a.start_time
-            if a.type == Type.Data:
-                data_times.append(run_time)
-            elif a.type == Type.Metadata:
-                meta_times.append(run_time)
-            elif a.type == Type.System:
-                system_times.append(run_time)
-            else:
-                print("type didnt match")
-        else:
-            print("Couldn't find process in the state dict")
-        continue
-
-total_time = float(sum(data_times) + sum(meta_times) + sum(system_times))
-total_len = len(data_times) + len(meta_times) + len(system_times)
-
-meta_times.sort()
-data_times.sort()
-system_times.sort()
-
-print("Totals:")
-print("\tTotal time:\t%f" % total_time)
-print("\tAverage time:\t%f" % float(total_time / total_len))
-print("\tAllocations:\t%d" % total_len)
-print("Metadata:")
-print("\tTotal time:\t%f" % float(sum(meta_times)))
-print("\tAverage time:\t%f" % float(sum(meta_times) / len(meta_times)))
-print("\tMin time:\t%f" % meta_times[0])
-print("\tMax time:\t%f" % meta_times[-1])
-print("\tAllocations:\t%d" % len(meta_times))
-print("Data:")
-print("\tTotal time:\t%f" % float(sum(data_times)))
-print("\tAverage time:\t%f" % float(sum(data_times) / len(data_times)))
-print("\tMin time:\t%f" % data_times[0])
-print("\tMax time:\t%f" % data_times[-1])
-print("\tAllocations:\t%d" % len(data_times))
-if len(system_times) > 0:
-    print("System:")
-    print("\tTotal time:\t%f" % float(sum(system_times)))
-    print("\tAverage time:\t%f" % float(sum(system_times) / len(system_times)))
-    print("\tMin time:\t%f" % system_times[0])
-    print("\tMax time:\t%f" % system_times[-1])
-    print("\tAllocations:\t%d" % len(system_times))
+        key = task_key(ev.pid, ev.cpu)
+        self.state_dict.setdefault(key, []).append(alloc)
+
+    def reserve_extent(self, ev):
+        self.expire(ev.ts)
+        key = task_key(ev.pid, ev.cpu)
+        stack = self.state_dict.get(key)
+        if not stack:
+            self.unmatched += 1
+            return
+        a = stack.pop()
+        if not stack:
+            del self.state_dict[key]
+        run_time = ev.ts - a.start_time
+        if a.type is None:
+            self.untyped += 1
+            return
+        record(self.by_type, Type.names[a.type], run_time)
+        record(self.by_root, a.root, run_time)
+        record(self.by_cpu, a.cpu, run_time)
+        record(self.by_size, size_class(a.len), run_time)
+
+    def report(self):
+        print("Reserves with no allocation:\t%d" % self.unmatched)
+        print("Abandoned allocations:\t\t%d" % self.abandoned)
+        print("Still in flight at the end:\t%d" %
+              sum(len(stack) for stack in self.state_dict.values()))
+        if self.untyped:
+            print("Allocations with an unknown type:\t%d" % self.untyped)
+
+        totals = LogHistogram()
+        for hist in self.by_type.values():
+            totals.merge(hist)
+        for line in totals.report("Totals", scale=NSECS_IN_SEC):
+            print(line)
+        report("By type:", self.by_type)
+        report("By root:", dict((ftrace.root_name(root), hist) for root, hist
+                                in self.by_root.items()))
+        report("By cpu:", self.by_cpu, "cpu %d")
+        report("By requested size:", self.by_size, "<= %d bytes")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get timing info out of an " +
+                                        "allocator trace")
+    parser.add_argument('infile', metavar='file', help='Trace file to ' +
+                        'process, either ftrace text or a trace.dat')
+    parser.add_argument('-m', '--max-age', type=float, default=10.0,
+                        help="Seconds an allocation can be in flight before " +
+                        "we give up on seeing its btrfs_reserve_extent")
+
+    args = parser.parse_args()
+
+    pipeline = ftrace.Pipeline([AllocatorAnalyzer(args.max_age)])
+    pipeline.run(args.infile)
+    pipeline.report()
 
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+import argparse
+import ftrace
+
+# name: (script, analyzer class)
+ANALYZERS = { "space": ("btrfs-space-visualization.py", "SpaceAnalyzer"),
+              "leak": ("space-leak.py", "LeakAnalyzer"),
+              "cluster": ("cluster-trace.py", "ClusterAnalyzer"),
+              "alloc": ("allocator-timing.py", "AllocatorAnalyzer"),
+            }
+DEFAULT_ORDER = ["space", "leak", "cluster", "alloc"]
+
+def make_analyzer(name, args):
+    script, cls = ANALYZERS[name]
+    module = ftrace.load_script(script)
+    if name == "space":
+        # The space accounting takes the visualizer's own options, all we
+        # need is its defaults for a non-gui run over the whole trace
+        space_args = module.make_parser().parse_args(["-c", "-i", args.infile])
+        space_args.fsid = args.fsid
+        return getattr(module, cls)(space_args)
+    if name == "alloc":
+        return getattr(module, cls)(args.max_age)
+    return getattr(module, cls)()
+
+parser = argparse.ArgumentParser(description="Run several of the btrfs " +
+                                 "analyzers over a trace in a single pass")
+parser.add_argument('infile', metavar='file', help='Trace file to process, ' +
+                    'either ftrace text or a trace.dat')
+parser.add_argument('-a', '--analyzers', type=str,
+                    default=",".join(DEFAULT_ORDER),
+                    help="Comma separated list of analyzers to run, out of " +
+                    ", ".join(DEFAULT_ORDER))
+parser.add_argument('-f', '--fsid', type=str,
+                    help="Specify the fsid the space accounting cares about")
+parser.add_argument('-m', '--max-age', type=float, default=10.0,
+                    help="Seconds an allocation can be in flight before we " +
+                    "give up on seeing its btrfs_reserve_extent")
+
+args = parser.parse_args()
+
+names = [name for name in args.analyzers.split(",") if name]
+for name in names:
+    if name not in ANALYZERS:
+        parser.error("Unknown analyzer '%s'" % name)
+
+pipeline = ftrace.Pipeline([make_analyzer(name, args) for name in names])
+pipeline.run(args.infile)
+pipeline.report()
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
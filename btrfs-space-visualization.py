@@ -1,22 +1,316 @@
 import os
 import argparse
 import subprocess
-import gc
 import sys
 import time
+import resource
 import binascii
-from tracecmd import Trace
+import copy
+import heapq
+import multiprocessing
+import threading
+import traceback
+from array import array
+from itertools import repeat
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+from bisect import bisect_left, bisect_right
+import ftrace
+from histogram import LogHistogram
 from ctracecmd import pevent_register_comm
 from ctracecmd import pevent_data_comm_from_pid
 from ctracecmd import py_supress_trace_output
-from ctracecmd import tracecmd_buffer_instances
-from ctracecmd import tracecmd_buffer_instance_handle
+from ctracecmd import tracecmd_set_all_cpus_to_timestamp
 
 NSECS_IN_SEC = 1000000000
-reservations = {}
-block_groups = []
-space_infos = []
-flush_events = []
+CACHE_VERSION = 11
+LIVE_INSTANCE = "/sys/kernel/debug/tracing/instances/enospc"
+LIVE_QUEUE_SIZE = 100000
+TRACE_EVENTS = [ "btrfs:btrfs_add_block_group",
+                 "btrfs:btrfs_space_reservation",
+                 "btrfs:btrfs_reserved_extent_free",
+                 "btrfs:btrfs_trigger_flush",
+                 "btrfs:btrfs_flush_space",
+                 "btrfs:btrfs_reserve_extent",
+                 "btrfs:btrfs_failed_cluster_setup",
+               ]
+
+class BlockGroupIndex:
+    # Block groups never overlap, so keeping them sorted by their start offset
+    # lets us find the one containing a given byte with a single bisect.
+    def __init__(self):
+        self.starts = []
+        self.groups = []
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def insert(self, block_group):
+        pos = bisect_left(self.starts, block_group.offset)
+        if pos < len(self.starts) and self.starts[pos] == block_group.offset:
+            self.groups[pos] = block_group
+            return
+        self.starts.insert(pos, block_group.offset)
+        self.groups.insert(pos, block_group)
+
+    def remove(self, offset):
+        pos = bisect_left(self.starts, offset)
+        if pos == len(self.starts) or self.starts[pos] != offset:
+            return None
+        del self.starts[pos]
+        return self.groups.pop(pos)
+
+    def find(self, offset):
+        pos = bisect_right(self.starts, offset) - 1
+        if pos < 0:
+            return None
+        block_group = self.groups[pos]
+        if block_group.offset + block_group.size > offset:
+            return block_group
+        return None
+
+class FreeSpace:
+    # How many free extents of each size there are across the block groups
+    # of a filesystem, kept up to date by their ExtentMaps.
+    def __init__(self):
+        self.sizes = {}
+        self.count = 0
+
+    def add(self, size):
+        if size <= 0:
+            return
+        self.sizes[size] = self.sizes.get(size, 0) + 1
+        self.count += 1
+
+    def remove(self, size):
+        if size <= 0:
+            return
+        left = self.sizes[size] - 1
+        if left:
+            self.sizes[size] = left
+        else:
+            del self.sizes[size]
+        self.count -= 1
+
+    def largest(self):
+        if not self.sizes:
+            return 0
+        return max(self.sizes)
+
+    def histogram(self):
+        hist = LogHistogram()
+        for size, count in self.sizes.items():
+            hist.record(size, count)
+        return hist
+
+class ExtentMap:
+    # The allocated ranges of one block group as sorted [start, end) pairs,
+    # with touching ranges merged, so the free extents are the gaps between
+    # them.  Every change only looks at the ranges it touches.
+    def __init__(self, offset, size, free_space):
+        self.offset = offset
+        self.end = offset + size
+        self.starts = array('l')
+        self.ends = array('l')
+        self.free_space = free_space
+        free_space.add(size)
+
+    def _ranges(self, lo, hi):
+        return [(self.starts[i], self.ends[i]) for i in range(lo, hi)]
+
+    def _gaps(self, left, right, ranges):
+        edges = [left]
+        for start, end in ranges:
+            edges.extend((start, end))
+        edges.append(right)
+        return [edges[i + 1] - edges[i] for i in range(0, len(edges), 2)]
+
+    def _update(self, lo, hi, pieces):
+        # Swap the ranges lo to hi for pieces and fix up the free extents
+        # between the neighbours on either side
+        left = self.ends[lo - 1] if lo > 0 else self.offset
+        right = self.starts[hi] if hi < len(self.starts) else self.end
+        for size in self._gaps(left, right, self._ranges(lo, hi)):
+            self.free_space.remove(size)
+        for size in self._gaps(left, right, pieces):
+            self.free_space.add(size)
+        self.starts[lo:hi] = array('l', [start for start, end in pieces])
+        self.ends[lo:hi] = array('l', [end for start, end in pieces])
+
+    def drop(self):
+        # The block group is going away, take its free extents with it
+        for size in self._gaps(self.offset, self.end,
+                               self._ranges(0, len(self.starts))):
+            self.free_space.remove(size)
+
+    def add(self, start, length):
+        end = min(start + length, self.end)
+        start = max(start, self.offset)
+        if start >= end:
+            return
+        # Everything overlapping or touching the new range gets merged in
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self._update(lo, hi, [(start, end)])
+
+    def remove(self, start, length):
+        end = start + length
+        lo = bisect_right(self.ends, start)
+        hi = bisect_left(self.starts, end)
+        if lo >= hi:
+            return
+        pieces = []
+        if self.starts[lo] < start:
+            pieces.append((self.starts[lo], start))
+        if self.ends[hi - 1] > end:
+            pieces.append((end, self.ends[hi - 1]))
+        self._update(lo, hi, pieces)
+
+class UsageGrid:
+    # The used bytes of each block group at the end of every interval of trace
+    # time, binned as the events go by so the heatmap only has to color in
+    # the cells.  Rows hold -1 for the intervals before their block group
+    # showed up, and stop at the last interval anything changed in.
+    # block_groups are the ones already there when resuming from a
+    # checkpoint, they get their rows at the first event.  Once a row would
+    # grow past MAX_COLUMNS the interval is doubled and the columns merged
+    # pairwise, so long traces don't grow the grid without bound.
+    MAX_COLUMNS = 2048
+
+    def __init__(self, interval, block_groups=()):
+        self.interval = interval
+        self.start = None
+        self.rows = {}
+        self.sizes = {}
+        self.restored = list(block_groups)
+
+    def add(self, ts, block_group):
+        # A block group read in again at the same offset keeps its row
+        if block_group.offset not in self.rows:
+            self.rows[block_group.offset] = array('l')
+        self.sizes[block_group.offset] = block_group.size
+        self.record(ts, block_group)
+
+    def record(self, ts, block_group):
+        if self.start is None:
+            self.start = ts
+            for restored in self.restored:
+                self.add(ts, restored)
+            self.restored = []
+        col = (ts - self.start) // self.interval
+        while col >= self.MAX_COLUMNS:
+            self.merge_columns()
+            col = (ts - self.start) // self.interval
+        row = self.rows.get(block_group.offset)
+        if row is None:
+            self.add(ts, block_group)
+            return
+        if len(row) <= col:
+            last = row[-1] if row else -1
+            row.extend(repeat(last, col + 1 - len(row)))
+        row[col] = block_group.used
+
+    def merge_columns(self):
+        # Each merged column ends where the second of its pair did
+        self.interval *= 2
+        for offset, row in self.rows.items():
+            merged = row[1::2]
+            if len(row) % 2:
+                merged.append(row[-1])
+            self.rows[offset] = merged
+
+    def sorted_rows(self):
+        return [(offset, self.sizes[offset], self.rows[offset])
+                for offset in sorted(self.rows.keys())]
+
+# Every filesystem in the trace by its hexlified fsid
+filesystems = {}
+checkpoints = []
+
+class SpaceSeries:
+    def __init__(self):
+        # Only the points where the running total changes are stored, the value
+        # at any other time is whatever the last change before it was.
+        self.times = array('l')
+        self.vals = array('l')
+        self.total = 0
+        self.levels = None
+
+    def record(self, ts, value):
+        self.total += value
+        self.levels = None
+        if len(self.times) and self.times[-1] == ts:
+            self.vals[-1] = self.total
+        else:
+            self.times.append(ts)
+            self.vals.append(self.total)
+
+    def trim(self, ts):
+        # Drop everything before ts, but keep the change that was current at
+        # ts so the value at the start of what's left is still right
+        pos = bisect_right(self.times, ts) - 1
+        if pos > 0:
+            del self.times[:pos]
+            del self.vals[:pos]
+            self.levels = None
+
+    def _pairs(self, l, func):
+        half = len(l) // 2
+        ret = array('l', map(func, l[0:half * 2:2], l[1:half * 2:2]))
+        if len(l) % 2:
+            ret.append(l[-1])
+        return ret
+
+    def build_levels(self):
+        # Each level halves the one below it, keeping the first timestamp and
+        # the min and max value of every pair, so no spike is ever averaged
+        # away no matter how far we zoom out.
+        times, mins, maxs = self.times, self.vals, self.vals
+        self.levels = [(times, mins, maxs)]
+        while len(times) > 1:
+            times = times[::2]
+            mins = self._pairs(mins, min)
+            maxs = self._pairs(maxs, max)
+            self.levels.append((times, mins, maxs))
+
+    def window(self, ts_start, ts_end, max_points):
+        if self.levels is None:
+            self.build_levels()
+        start = 0
+        end = len(self.times)
+        if ts_start > 0:
+            start = max(bisect_right(self.times, ts_start) - 1, 0)
+        if ts_end > 0:
+            end = bisect_right(self.times, ts_end)
+        if end - start <= max_points:
+            return list(self.times[start:end]), list(self.vals[start:end])
+
+        # Every bucket we draw is two points, its min and its max
+        level = 1
+        while (((end - start) >> level) * 2 > max_points and
+               level < len(self.levels) - 1):
+            level += 1
+        times, mins, maxs = self.levels[level]
+        xpoints = []
+        ypoints = []
+        for i in range(start >> level, ((end - 1) >> level) + 1):
+            xpoints.append(times[i])
+            xpoints.append(times[i])
+            ypoints.append(mins[i])
+            ypoints.append(maxs[i])
+        return xpoints, ypoints
 
 class SpaceHistory:
     def __init__(self):
@@ -25,112 +319,114 @@ class SpaceHistory:
         self.readonly_bytes = 0
         self.total_bytes = 0
 
-        self.running_totals = {}
         self.hists = {}
         self.times = {}
         self.vals = {}
         self.enabled = True
+        self.timeline = None
+        self.timeline_samples = 0
 
     def add_space(self, name, ts, value):
         if not self.enabled:
             return
         if name not in self.hists:
-            self.hists[name] = {}
-            self.running_totals[name] = 0
-
-            # We have to back populate the timestamps from the first event we've
-            # recorded upt through current time so that all the histories match
-            # up
-            for n in self.running_totals.keys():
-                if n == name:
-                    continue
-                for t in self.hists[n].keys():
-                    self.hists[name][t] = 0
-                break
-        self.running_totals[name] += value
-
-        for n in self.running_totals.keys():
-            self.hists[n][ts] = self.running_totals[n]
+            self.hists[name] = SpaceSeries()
+        self.hists[name].record(ts, value)
 
     def remove_space(self, name, ts, value):
         if not self.enabled:
             return
         if name not in self.hists:
             print("WOOOOOOOPPPPSSSS!")
-            self.hists[name] = {}
-            self.running_totals[name] = 0
-        self.running_totals[name] -= value
+            self.hists[name] = SpaceSeries()
+        self.hists[name].record(ts, -value)
 
-        for n in self.running_totals.keys():
-            self.hists[n][ts] = self.running_totals[n]
+    def restore(self, ts, totals):
+        self.hists = {}
+        self.timeline = None
+        for name, total in totals.items():
+            self.hists[name] = SpaceSeries()
+            self.hists[name].record(ts, total)
+
+    def latest(self):
+        latest = 0
+        for series in self.hists.values():
+            if len(series.times) and series.times[-1] > latest:
+                latest = series.times[-1]
+        return latest
+
+    def trim(self, ts):
+        for series in self.hists.values():
+            series.trim(ts)
+        self.timeline = None
+
+    def _timeline(self):
+        # The series only ever grow, so the merged timeline only needs to be
+        # rebuilt when the number of samples changes.
+        samples = sum(len(series.times) for series in self.hists.values())
+        if self.timeline is not None and self.timeline_samples == samples:
+            return self.timeline
+        times = array('l')
+        for ts in heapq.merge(*[s.times for s in self.hists.values()]):
+            if not len(times) or times[-1] != ts:
+                times.append(ts)
+        self.timeline = times
+        self.timeline_samples = samples
+        return times
 
-    def _build_list(self, hist, ts_start, ts_end):
-        times = sorted(list(hist.keys()))
+    def _build_list(self, series, times, ts_start, ts_end):
+        start = 0
+        end = len(times)
+        if ts_start > 0:
+            start = bisect_left(times, ts_start)
+        if ts_end > 0:
+            end = bisect_right(times, ts_end)
+        times = list(times[start:end])
         vals = []
-        start = None
-        end = 0
-        for i in range(0, len(times)):
-            ts = times[i]
-            if ts_start > 0:
-                if ts < ts_start:
-                    continue
-                elif start is None:
-                    start = i
-            if ts_end > 0 and ts > ts_end:
-                end = i
-                break
-            vals.append(hist[ts])
-        if start is not None:
-            times = times[start:end]
-        return times, vals
+        if not times:
+            return times, vals
 
-    def _average_down_list(self, orig_list, max_len):
-        orig_len = len(orig_list)
-        if orig_len <= max_len:
-            return orig_list
-        scale = int(orig_len / max_len)
-        l = []
+        # Step forward through the changes so we always have the value that
+        # was current at each point in time
+        pos = bisect_right(series.times, times[0])
         value = 0
-        cur = 0
-        for i in orig_list:
-            value += i
-            cur += 1
-            if cur == scale:
-                l.append(int(value / scale))
-                cur = 0
-                value = 0
-        if cur:
-            l.append(int(value / cur))
-        return l
-
-    def _scale_down_list(self, orig_list, max_len):
-        orig_len = len(orig_list)
-        if orig_len <= max_len:
-            return orig_list
-        scale = int(orig_len / max_len)
-        l = []
-        cur = 0
-        while cur < orig_len:
-            l.append(orig_list[cur])
-            cur += scale
-        if len(l) < max_len:
-            l.append(orig_list[-1])
-        return l
+        if pos > 0:
+            value = series.vals[pos - 1]
+        for ts in times:
+            while pos < len(series.times) and series.times[pos] <= ts:
+                value = series.vals[pos]
+                pos += 1
+            vals.append(value)
+        return times, vals
 
     def build_lists(self, max_vals=0, ts_start=0, ts_end=0):
+        if max_vals:
+            for n in self.hists.keys():
+                self.times[n], self.vals[n] = self.hists[n].window(ts_start,
+                                                                   ts_end,
+                                                                   max_vals)
+            return
+        times = self._timeline()
         for n in self.hists.keys():
-            print("length of hist %s is %d" % (n, len(self.hists[n].keys())))
-            self.times[n], self.vals[n] = self._build_list(self.hists[n],
+            print("length of hist %s is %d" % (n, len(self.hists[n].times)))
+            self.times[n], self.vals[n] = self._build_list(self.hists[n], times,
                                                            ts_start, ts_end)
-        if max_vals:
-            for n in self.times.keys():
-                self.times[n] = self._scale_down_list(self.times[n], max_vals)
-                self.vals[n] = self._average_down_list(self.vals[n], max_vals)
 
 class Blockgroup:
     def __init__(self, offset, size):
         self.offset = offset
         self.size = size
+        self.used = 0
+        # Only with --fragmentation, and only for block groups we know the
+        # whole layout of
+        self.extents = None
+
+    def __getstate__(self):
+        # Extent maps are far too big to copy into every checkpoint and the
+        # cache, block groups come back from those unmapped
+        state = dict(self.__dict__)
+        state["extents"] = None
+        return state
 
 class Spaceinfo:
     BTRFS_BLOCK_GROUP_DATA = (1 << 0)
@@ -151,19 +447,121 @@ class Spaceinfo:
         self.bytes_used += bytes_used
         self.bytes_readonly += bytes_super
 
-def find_block_group(offset):
-    for  block_group in block_groups:
-        if (block_group.offset <= offset) and ((block_group.offset + block_group.size) > offset):
-            return block_group
-    return None
+class Filesystem:
+    # All of the accounting for one fsid.  index is the order we first saw
+    # the filesystems in.
+    def __init__(self, fsid, index, enabled=True):
+        self.fsid = fsid
+        self.index = index
+        self.space_history = SpaceHistory()
+        self.space_history.enabled = enabled
+        self.space_infos = []
+        self.block_groups = BlockGroupIndex()
+        self.reservations = {}
+        self.flush_events = []
+        self.mixed_bg = False
+        self.enospc_flushes = 0
+        self.preempt_flushes = 0
+
+        # Fragmentation of the block groups we have extent maps for, sampled
+        # as (ts, free extents, largest free extent, failed cluster setups
+        # since the last sample)
+        self.free_space = FreeSpace()
+        self.frag_samples = []
+        self.failed_clusters = 0
+        self.unmapped_groups = 0
+
+        # Only with --heatmap
+        self.usage = None
 
-def find_space_info(flags):
-    for space_info in space_infos:
-        if space_info.flags == flags:
-            return space_info
-    space_info = Spaceinfo(flags)
-    space_infos.append(space_info)
-    return space_info
+        self.flush_cycles = FlushCycles()
+
+    @property
+    def name(self):
+        if self.fsid is None:
+            return "unknown fsid"
+        return self.fsid
+
+    def get_state(self):
+        return (self.index, self.space_infos, self.block_groups,
+                self.reservations, self.mixed_bg)
+
+    def set_state(self, state):
+        (self.index, self.space_infos, self.block_groups, self.reservations,
+         self.mixed_bg) = state
+        # The block groups lost their extent maps on the way, so start the
+        # free space over with none of them mapped
+        self.free_space = FreeSpace()
+        self.unmapped_groups = len(self.block_groups)
+
+    def sample_fragmentation(self, ts):
+        self.frag_samples.append((ts, self.free_space.count,
+                                  self.free_space.largest(),
+                                  self.failed_clusters))
+        self.failed_clusters = 0
+
+    def find_block_group(self, offset):
+        return self.block_groups.find(offset)
+
+    def bytes_may_use(self):
+        # Per space_info, so a flush is only measured against its own
+        return dict((space_info.flags, space_info.bytes_may_use)
+                    for space_info in self.space_infos)
+
+    def balances(self):
+        # Everything the leak check expects to be back at zero by the end
+        ret = dict(self.reservations)
+        for space_info in self.space_infos:
+            ret["bytes_may_use %d" % space_info.flags] = \
+                    space_info.bytes_may_use
+        return ret
+
+    def find_space_info(self, flags):
+        for space_info in self.space_infos:
+            if space_info.flags == flags:
+                return space_info
+        space_info = Spaceinfo(flags)
+        self.space_infos.append(space_info)
+        return space_info
+
+def sorted_filesystems():
+    return sorted(filesystems.values(), key=lambda fs: fs.index)
+
+def fsid_key(fsid):
+    # --fsid can be given as a uuid, filesystems are keyed by the bare hex
+    return fsid.replace("-", "").lower()
+
+def selected_filesystem(args):
+    # The one asked for with --fsid, otherwise the first one in the trace
+    if args.fsid:
+        return filesystems.get(fsid_key(args.fsid))
+    if not filesystems:
+        return None
+    return sorted_filesystems()[0]
+
+class Checkpoint:
+    # A copy of the accounting state of every filesystem as it was before the
+    # event at ts, so a parse can pick up from here instead of from the start
+    # of the trace.
+    def __init__(self, ts):
+        self.ts = ts
+        self.totals = {}
+        self.balances = {}
+        states = {}
+        for fsid, fs in filesystems.items():
+            self.totals[fsid] = dict((n, s.total) for n, s in
+                                     fs.space_history.hists.items())
+            self.balances[fsid] = fs.balances()
+            states[fsid] = fs.get_state()
+        self.state = copy.deepcopy(states)
+
+    def restore(self, enabled):
+        filesystems.clear()
+        for fsid, state in copy.deepcopy(self.state).items():
+            fs = Filesystem(fsid, 0, enabled)
+            fs.set_state(state)
+            fs.space_history.restore(self.ts, self.totals[fsid])
+            filesystems[fsid] = fs
 
 def pretty_size(size):
     names = ["bytes", "kib", "mib", "gib", "tib"]
@@ -173,42 +571,137 @@ def pretty_size(size):
         i += 1
     return str(size) + names[i]
 
-def add_bg(rec):
+def add_bg(create, flags, size):
     ret = "read, "
-    if rec.num_field("create") == 1:
+    if create == 1:
         ret = "create, "
-    flags = rec.num_field("flags")
     if Spaceinfo.BTRFS_BLOCK_GROUP_DATA & flags:
         ret += "BTRFS_BLOCK_GROUP_DATA, "
     elif Spaceinfo.BTRFS_BLOCK_GROUP_METADATA & flags:
         ret += "BTRFS_BLOCK_GROUP_METADATA, "
     else:
         ret += "BTRFS_BLOCK_GROUP_SYSTEM, "
-    ret += pretty_size(rec.num_field("size"))
+    ret += pretty_size(size)
     return ret
 
-def flush_event(rec):
-    state = rec.num_field("state")
+FLUSH_STATES = { 1: "FLUSH_DELAYED_ITEMS_NR",
+                 2: "FLUSH_DELAYED_ITEMS",
+                 3: "FLUSH_DELALLOC",
+                 4: "FLUSH_DELALLOC_WAIT",
+                 5: "ALLOC_CHUNK",
+                 6: "COMMIT_TRANS",
+               }
+
+def flush_event(state, num_bytes, orig_bytes, ret):
     event_str = ""
-    if state == 1:
-        event_str += "FLUSH_DELAYED_ITEMS_NR: "
-    elif state == 2:
-        event_str += "FLUSH_DELAYED_ITEMS: "
-    elif state == 3:
-        event_str += "FLUSH_DELALLOC: "
-    elif state == 4:
-        event_str += "FLUSH_DELALLOC_WAIT: "
-    elif state == 5:
-        event_str += "ALLOC_CHUNK: "
-    elif state == 6:
-        event_str += "COMMIT_TRANS: "
+    if state in FLUSH_STATES:
+        event_str += FLUSH_STATES[state] + ": "
     event_str += "num_bytes = "
-    event_str += pretty_size(rec.num_field("num_bytes"))
+    event_str += pretty_size(num_bytes)
     event_str += ", orig_bytes = "
-    event_str += pretty_size(rec.num_field("orig_bytes"))
-    event_str += ", ret = " + str(rec.num_field("ret"))
+    event_str += pretty_size(orig_bytes)
+    event_str += ", ret = " + str(ret)
     return event_str
 
+class FlushEvent(object):
+    # One row of the event list.  Rows are read by column index, which is
+    # the order of the slots.
+    __slots__ = ("ts", "pid", "cpu", "name", "value")
+
+    def __init__(self, ts, pid, cpu, name, value):
+        self.ts = ts
+        self.pid = pid
+        self.cpu = cpu
+        self.name = name
+        self.value = value
+
+    def __getitem__(self, column):
+        return getattr(self, self.__slots__[column])
+
+# flush_events only keep the raw values of each event, the string shown in the
+# event list is made from them when the row is actually displayed.
+def describe_flush_event(event):
+    if event.name == "btrfs_add_block_group":
+        return add_bg(*event.value)
+    if event.name == "btrfs_flush_space":
+        return flush_event(*event.value)
+    return str(event.value)
+
+class FlushCycles:
+    # Ties each btrfs_trigger_flush to the flush_space states run for it and
+    # to the reservation that ends the wait of the task that triggered it.
+    # Only the task that starts a flush traces a trigger, so tasks queueing
+    # up behind it aren't seen waiting.
+    # A state is timed from the last boundary of the task running it, either
+    # its previous flush_space or the trigger that started the cycle, and what
+    # it reclaimed is how far bytes_may_use of the space_info it flushed
+    # dropped over that time.
+    def __init__(self):
+        # (ts, pid, bytes) of each trigger still waiting on its ticket, oldest
+        # first
+        self.waiters = []
+        # pid of each task flushing to the ts it last ran a state at and
+        # bytes_may_use per space_info flags at that point, and the trigger
+        # no flusher has picked up yet
+        self.marks = {}
+        self.pending = None
+        self.triggers = 0
+        self.untimed_states = 0
+
+        # Per flush state, and per task as [stall time, number of waits]
+        self.state_times = {}
+        self.reclaimed = {}
+        self.stalls = { "reserved": LogHistogram(), "enospc": LogHistogram() }
+        self.task_stalls = {}
+
+    def trigger(self, ts, pid, reason, num_bytes, may_use):
+        self.triggers += 1
+        if not self.waiters:
+            # Nobody is waiting on the last cycle any more, start a new one
+            self.marks.clear()
+            self.pending = (ts, may_use)
+        # Preemptive flushes don't hold anybody up
+        if reason == "enospc":
+            self.waiters.append((ts, pid, num_bytes))
+
+    def flush_space(self, ts, pid, state, flags, may_use):
+        mark = self.marks.get(pid)
+        if mark is None:
+            mark = self.pending
+            self.pending = None
+        self.marks[pid] = (ts, may_use)
+        if mark is None:
+            self.untimed_states += 1
+            return
+        if state not in self.state_times:
+            self.state_times[state] = LogHistogram()
+            self.reclaimed[state] = 0
+        self.state_times[state].record(ts - mark[0])
+        self.reclaimed[state] += max(mark[1].get(flags, 0) -
+                                     may_use.get(flags, 0), 0)
+
+    def reservation(self, ts, pid, num_bytes, outcome):
+        # A granted ticket is reserved by whoever freed the space, so it is
+        # traced under their pid and only the size ties it to the waiter. A
+        # failed one is traced by the waiter itself.
+        for i, (start, waiter, wanted) in enumerate(self.waiters):
+            if outcome == "enospc":
+                if waiter == pid:
+                    break
+            elif wanted == num_bytes:
+                break
+        else:
+            return
+        del self.waiters[i]
+        pid = waiter
+        self.stalls[outcome].record(ts - start)
+        task = self.task_stalls.setdefault(pid, [0, 0])
+        task[0] += ts - start
+        task[1] += 1
+        if not self.waiters:
+            self.marks.clear()
+            self.pending = None
+
 def record_space(flags, mixed_bg):
     if flags & Spaceinfo.BTRFS_BLOCK_GROUP_METADATA:
         return True
@@ -218,8 +711,167 @@ def record_space(flags, mixed_bg):
         return True
     return False
 
-def parse_tracefile(args, space_history):
-    trace = Trace(args.infile)
+# The fields we use out of each event, split into numeric and string fields.
+# These are all that is kept when events are decoded in the worker processes.
+EVENT_FIELDS = {
+    "btrfs_add_block_group": (["offset", "size", "flags", "bytes_used",
+                               "bytes_super", "create"], []),
+    "btrfs_space_reservation": (["val", "bytes", "reserve"], ["type"]),
+    "btrfs_reserve_extent": (["start", "len"], []),
+    "btrfs_reserved_extent_free": (["start", "len"], []),
+    "btrfs_trigger_flush": (["bytes"], ["reason"]),
+    "btrfs_flush_space": (["state", "flags", "num_bytes", "orig_bytes", "ret"],
+                          []),
+    "btrfs_failed_cluster_setup": ([], []),
+}
+
+class DecodedField(object):
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+class DecodedEvent(object):
+    # A picklable copy of the parts of a tracecmd Event that parse_tracefile
+    # looks at, with the same accessors so it can be used in its place.
+    __slots__ = ("ts", "pid", "cpu", "name", "fields")
+
+    def __init__(self, ts, pid, cpu, name, fields):
+        self.ts = ts
+        self.pid = pid
+        self.cpu = cpu
+        self.name = name
+        self.fields = fields
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __getitem__(self, name):
+        return DecodedField(self.fields[name])
+
+    def num_field(self, name):
+        return self.fields[name]
+
+    def str_field(self, name):
+        return self.fields[name]
+
+def decode_event(rec):
+    fields = {}
+    num_fields, str_fields = EVENT_FIELDS[rec.name]
+    for f in num_fields:
+        fields[f] = rec.num_field(f)
+    for f in str_fields:
+        fields[f] = rec.str_field(f)
+    if "fsid" in rec:
+        fields["fsid"] = rec["fsid"].data
+    return DecodedEvent(rec.ts, rec.pid, rec.cpu, rec.name, fields)
+
+def serial_events(trace):
+    while True:
+        rec = trace.read_next_event()
+        if rec is None:
+            return
+        yield rec
+
+def cpu_events(trace, cpu):
+    while True:
+        rec = trace.read_event(cpu)
+        if rec is None:
+            return
+        if rec.name in EVENT_FIELDS:
+            ev = decode_event(rec)
+            yield (ev.ts, ev.cpu, ev)
+
+# Workers send lists of events, then None once they are done.  A worker that
+# fails sends its traceback instead, so the accounting stops rather than
+# carrying on without that worker's cpus.
+def decode_worker(infile, cpus, queue, start_ts, batch_size=4096):
+    try:
+        trace = ftrace.open_trace(infile)
+        if start_ts:
+            tracecmd_set_all_cpus_to_timestamp(trace._handle, start_ts)
+        batch = []
+        streams = [cpu_events(trace, cpu) for cpu in cpus]
+        for item in heapq.merge(*streams):
+            batch.append(item)
+            if len(batch) == batch_size:
+                queue.put(batch)
+                batch = []
+        if batch:
+            queue.put(batch)
+    except Exception:
+        queue.put(traceback.format_exc())
+        return
+    queue.put(None)
+
+def queue_events(queue, worker):
+    while True:
+        try:
+            batch = queue.get(timeout=1)
+        except Empty:
+            # Anything a worker sent is flushed before it exits, so one that
+            # is gone with nothing left to read died without saying so
+            if worker.exitcode is not None:
+                raise RuntimeError("Decode worker exited with %d" %
+                                   worker.exitcode)
+            continue
+        if batch is None:
+            return
+        if not isinstance(batch, list):
+            raise RuntimeError("Decode worker failed:\n%s" % batch)
+        for item in batch:
+            yield item
+
+def parallel_events(infile, nr_cpus, jobs, start_ts=0):
+    # Each worker decodes every jobs'th cpu buffer and merges its own cpus, we
+    # then merge the workers so the accounting still sees events in order.
+    workers = []
+    streams = []
+    for i in range(0, min(jobs, nr_cpus)):
+        queue = multiprocessing.Queue(16)
+        p = multiprocessing.Process(target=decode_worker,
+                                    args=(infile, range(i, nr_cpus, jobs),
+                                          queue, start_ts))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+        streams.append(queue_events(queue, p))
+    try:
+        for ts, cpu, ev in heapq.merge(*streams):
+            yield ev
+        for p in workers:
+            p.join()
+            if p.exitcode:
+                raise RuntimeError("Decode worker exited with %d" %
+                                   p.exitcode)
+    finally:
+        for p in workers:
+            p.terminate()
+
+def time_window(args):
+    # --start and --end are relative to the first event in the trace
+    ts_start = 0
+    ts_end = 0
+    if not checkpoints:
+        return ts_start, ts_end
+    first_ts = checkpoints[0].ts
+    if args.start:
+        ts_start = first_ts + int(args.start * NSECS_IN_SEC)
+    if args.end:
+        ts_end = first_ts + int(args.end * NSECS_IN_SEC)
+    return ts_start, ts_end
+
+def find_checkpoint(ts):
+    # None if there is nothing to resume from
+    if not checkpoints:
+        return None
+    pos = bisect_right([c.ts for c in checkpoints], ts) - 1
+    if pos < 0:
+        return checkpoints[0]
+    return checkpoints[pos]
+
+def parse_tracefile(args, checkpoint=None):
+    trace = ftrace.open_trace(args.infile)
 
     cpustats = trace.cpustats()
 
@@ -227,199 +879,638 @@ def parse_tracefile(args, space_history):
     cpus = cpustats.split('\n\n\n')
     cpus = cpus[1].split('\n\n')
 
-    instances = tracecmd_buffer_instances(trace._handle)
-    if instances != 0:
-        new_handle = tracecmd_buffer_instance_handle(trace._handle, 0)
-        trace._handle = new_handle
-
     total_events = 0
     for cpu in range(0, trace.cpus):
         stats = dict(item.split(':') for item in cpus[cpu].split("\n"))
         total_events += int(stats['read events'])
 
     print("Total events %d" % (total_events))
-    # Just assume 10k events per second to start off with
-    rem = total_events / 10000
 
-    cur_event = 0
-    obj_count = 0
-    enospc_flushes = 0
-    preempt_flushes = 0
-    start_time = time.time()
-    rem = 0
-    run_limit = -1
-    mixed_bg = False
-
-    seen_uuids = []
-    if args.fsid:
-        seen_uuids.append(args.fsid)
+    # Seek to the checkpoint we are resuming from
+    start_ts = 0
+    if checkpoint:
+        start_ts = checkpoint.ts
+    return account_events(args, trace_events(args, trace, start_ts),
+                          total_events, checkpoint)
 
-    while True:
-        if obj_count > 100000:
-            now = time.time()
-            t = now - start_time
-            start_time = now
-            t /= obj_count
-            rem = total_events - cur_event
-            rem *= t
-            gc.collect()
-            obj_count = 1
-        sys.stdout.write("\r%d - %s seconds remaining" % (cur_event, rem))
-        sys.stdout.flush()
-        rec = trace.read_next_event()
-        if rec is None:
-            break
+def trace_events(args, trace, start_ts=0):
+    if args.jobs > 1:
+        return parallel_events(args.infile, trace.cpus, args.jobs, start_ts)
+    if start_ts:
+        tracecmd_set_all_cpus_to_timestamp(trace._handle, start_ts)
+    return serial_events(trace)
+
+class SpaceAccounting:
+    # Does the accounting for one event at a time, so the same code can be fed
+    # by parse_tracefile, the live reader or the btrfs-analyze pipeline.
+    # Every filesystem in the trace is accounted for separately.
+    def __init__(self, args, checkpoint=None):
+        self.args = args
+        self.checkpoint = checkpoint
+        self.run_limit = -1
+        self.history_enabled = not args.nogtk
+        self.next_frag_sample = 0
+        self.frag_interval = 0
+        if args.fragmentation:
+            self.frag_interval = int(args.frag_interval * NSECS_IN_SEC)
+        self.heatmap_interval = 0
+        if args.heatmap:
+            self.heatmap_interval = int(args.heatmap_interval * NSECS_IN_SEC)
+
+        # The raw bytes of every fsid seen to its Filesystem, so each is only
+        # hexlified once.  Events without an fsid go to whichever filesystem
+        # we saw last.
+        self.fsids = {}
+        self.fs = None
+
+        # Either resume from a checkpoint, or record new ones as we go.
+        # There's nothing to resume when watching live, so don't hold on to
+        # them then.
+        self.last_ts = -1
+        self.next_checkpoint = 0
+        self.record_checkpoints = not checkpoint and not args.live
+        if checkpoint:
+            checkpoint.restore(self.history_enabled)
+        else:
+            filesystems.clear()
+            del checkpoints[:]
+        for fs in filesystems.values():
+            self.start_usage(fs)
+
+        self.handlers = {
+            "btrfs_add_block_group": self.add_block_group,
+            "btrfs_space_reservation": self.space_reservation,
+            "btrfs_reserve_extent": self.extent,
+            "btrfs_reserved_extent_free": self.extent,
+            "btrfs_trigger_flush": self.trigger_flush,
+            "btrfs_flush_space": self.flush_space,
+            "btrfs_failed_cluster_setup": self.failed_cluster_setup,
+        }
+
+    def set_profile(self, profile):
+        self.handlers = dict((name, profile.wrap(name, handler))
+                             for name, handler in self.handlers.items())
+
+    def handle(self, rec):
+        # Returns False once we are past the time limit and want no more
+        args = self.args
+
+        # Only snapshot between timestamps, so resuming from the checkpoint
+        # doesn't replay events that were already accounted for
+        if (self.record_checkpoints and rec.ts >= self.next_checkpoint and
+            rec.ts > self.last_ts):
+            checkpoints.append(Checkpoint(rec.ts))
+            self.next_checkpoint = (rec.ts +
+                                    args.checkpoint_interval * NSECS_IN_SEC)
+        self.last_ts = rec.ts
 
         # First figure out if we have a run time limit
-        if run_limit == -1:
+        if self.run_limit == -1:
             if args.time:
-                run_limit = rec.ts + (args.time * NSECS_IN_SEC)
+                self.run_limit = rec.ts + (args.time * NSECS_IN_SEC)
             else:
-                run_limit = 0
-        if run_limit > 0 and rec.ts > run_limit:
-            break
-        cur_event += 1
-        obj_count += 1
+                self.run_limit = time_window(args)[1]
+        if self.run_limit > 0 and rec.ts > self.run_limit:
+            return False
+
+        if self.frag_interval and rec.ts >= self.next_frag_sample:
+            for fs in filesystems.values():
+                fs.sample_fragmentation(rec.ts)
+            self.next_frag_sample = rec.ts + self.frag_interval
 
         if "fsid" in rec:
-            # Deal with multiple fsid's in the trace data
-            fsid = binascii.hexlify(rec["fsid"].data)
-            if fsid not in seen_uuids:
-                if len(seen_uuids):
-                    print("\nSaw a new uuid %s" % fsid)
-                seen_uuids.append(fsid)
-            if fsid != seen_uuids[0]:
-                continue
+            raw = rec["fsid"].data
+            fs = self.fsids.get(raw)
+            if fs is None:
+                fs = self.new_fsid(raw)
+            self.fs = fs
+        elif self.fs is None:
+            self.fs = self.get_filesystem(None)
 
-        if rec.name == "btrfs_add_block_group":
-            event_str = add_bg(rec)
-            flush_events.append([rec.ts, rec.pid, rec.cpu, rec.name, event_str])
-            flags = rec.num_field("flags")
-
-            # We only care about metadata for space history
-            if flags & Spaceinfo.BTRFS_BLOCK_GROUP_METADATA:
-                if flags & Spaceinfo.BTRFS_BLOCK_GROUP_DATA and not mixed_bg:
-                    print("\nMixed block group discovered")
-                    mixed_bg = True
-                space_history.add_space("Total", rec.ts, rec.num_field("size"))
-                space_history.add_space("Used", rec.ts,
-                                        rec.num_field("bytes_used"))
-                space_history.add_space("Readonly", rec.ts,
-                                        rec.num_field("bytes_super"))
-            space_info = find_space_info(flags)
-            space_info.add_block_group(rec.num_field("size"),
-                                       rec.num_field("bytes_used"),
-                                       rec.num_field("bytes_super"))
-            block_group = Blockgroup(rec.num_field("offset"),
-                                     rec.num_field("size"))
-            block_groups.append(block_group)
-            block_group.space_info = space_info
-        if rec.name == "btrfs_space_reservation":
-            reserve_type = rec.str_field("type")
-            reserve = rec.num_field("reserve")
-            if "enospc" in reserve_type:
-                space_info = find_space_info(rec.num_field("val"))
-                if args.nogtk:
-                    print("\nHit enospc, dumping info\n")
-                    for r in reservations.keys():
-                        print("%s: %d" % (r, reservations[r]))
-                    print("Space info %d, may_use %d, used %d, readonly %d\n" %
-                            (space_info.flags, space_info.bytes_may_use,
-                             space_info.bytes_used, space_info.bytes_readonly))
-                flush_events.append([rec.ts, rec.pid, rec.cpu, reserve_type,
-                                     str(rec.num_field("bytes"))])
-                continue
-            elif "space_info" in reserve_type:
-                space_info = find_space_info(rec.num_field("val"))
-                if reserve == 1:
-                    space_info.bytes_may_use += rec.num_field("bytes")
-                    space_history.add_space("Reserved", rec.ts,
-                                            rec.num_field("bytes"))
-                else:
-                    space_history.remove_space("Reserved", rec.ts,
-                                               rec.num_field("bytes"))
-                    space_info.bytes_may_use -= rec.num_field("bytes")
-            elif "pinned" in reserve_type:
-                space_info = find_space_info(rec.num_field("val"))
-                if reserve == 0:
-                    if record_space(space_info.flags, mixed_bg):
-                        space_history.remove_space("Used", rec.ts,
-                                                   rec.num_field("bytes"))
-                    space_info.bytes_used -= rec.num_field("bytes")
+        handler = self.handlers.get(rec.name)
+        if handler:
+            handler(rec)
+        return True
+
+    def get_filesystem(self, fsid):
+        fs = filesystems.get(fsid)
+        if fs is None:
+            if filesystems:
+                print("\nSaw a new uuid %s" % fsid)
+            fs = Filesystem(fsid, len(filesystems), self.history_enabled)
+            self.start_usage(fs)
+            filesystems[fsid] = fs
+        return fs
+
+    def start_usage(self, fs):
+        if self.heatmap_interval:
+            fs.usage = UsageGrid(self.heatmap_interval, fs.block_groups)
+
+    def new_fsid(self, raw):
+        fs = self.get_filesystem(binascii.hexlify(raw).decode("ascii"))
+        self.fsids[raw] = fs
+        return fs
+
+    def add_block_group(self, rec):
+        fs = self.fs
+        space_history = fs.space_history
+        ts = rec.ts
+        flags = rec.num_field("flags")
+        size = rec.num_field("size")
+        bytes_used = rec.num_field("bytes_used")
+        bytes_super = rec.num_field("bytes_super")
+        fs.flush_events.append(FlushEvent(ts, rec.pid, rec.cpu, rec.name,
+                                          (rec.num_field("create"), flags,
+                                           size)))
+
+        # We only care about metadata for space history
+        if flags & Spaceinfo.BTRFS_BLOCK_GROUP_METADATA:
+            if flags & Spaceinfo.BTRFS_BLOCK_GROUP_DATA and not fs.mixed_bg:
+                print("\nMixed block group discovered on %s" % fs.name)
+                fs.mixed_bg = True
+            space_history.add_space("Total", ts, size)
+            space_history.add_space("Used", ts, bytes_used)
+            space_history.add_space("Readonly", ts, bytes_super)
+        space_info = fs.find_space_info(flags)
+        space_info.add_block_group(size, bytes_used, bytes_super)
+        offset = rec.num_field("offset")
+        block_group = Blockgroup(offset, size)
+        block_group.used = bytes_used
+        block_group.space_info = space_info
+        if self.frag_interval:
+            old = fs.find_block_group(offset)
+            if old and old.offset == offset and old.extents:
+                old.extents.drop()
+            # We can't know where the space already in use when a block group
+            # is read in is, so those can't be mapped
+            if bytes_used == 0:
+                block_group.extents = ExtentMap(offset, size, fs.free_space)
             else:
-                if reserve == 1:
-                    space_history.add_space(reserve_type, rec.ts,
-                                            rec.num_field("bytes"))
-                else:
-                    space_history.remove_space(reserve_type, rec.ts,
-                                               rec.num_field("bytes"))
-            if reserve_type not in reservations:
-                reservations[reserve_type] = 0
+                fs.unmapped_groups += 1
+        fs.block_groups.insert(block_group)
+        if fs.usage:
+            fs.usage.add(ts, block_group)
+
+    def space_reservation(self, rec):
+        args = self.args
+        fs = self.fs
+        space_history = fs.space_history
+        reservations = fs.reservations
+        ts = rec.ts
+        reserve_type = rec.str_field("type")
+        reserve = rec.num_field("reserve")
+        num_bytes = rec.num_field("bytes")
+        if "enospc" in reserve_type:
+            space_info = fs.find_space_info(rec.num_field("val"))
+            if args.nogtk and ts >= time_window(args)[0]:
+                print("\nHit enospc on %s, dumping info\n" % fs.name)
+                for r in reservations.keys():
+                    print("%s: %d" % (r, reservations[r]))
+                print("Space info %d, may_use %d, used %d, readonly %d\n" %
+                        (space_info.flags, space_info.bytes_may_use,
+                         space_info.bytes_used, space_info.bytes_readonly))
+            fs.flush_events.append(FlushEvent(ts, rec.pid, rec.cpu,
+                                              reserve_type, num_bytes))
+            fs.flush_cycles.reservation(ts, rec.pid, num_bytes, "enospc")
+            return
+        elif "space_info" in reserve_type:
+            space_info = fs.find_space_info(rec.num_field("val"))
             if reserve == 1:
-                reservations[reserve_type] += rec.num_field("bytes")
-            else:
-                reservations[reserve_type] -= rec.num_field("bytes")
-        # For now just ignore btrfs_reserved_extent_alloc because we're not
-        # differentiating between bytes_reserved and bytes_used, we're just
-        # assuming they are the same.
-        if (rec.name == "btrfs_reserved_extent_free" or
-            rec.name == "btrfs_reserve_extent"):
-            block_group = find_block_group(rec.num_field("start"))
-            if not block_group:
-                print("Huh, didn't find a block group for %d" %
-                        (rec.num_field("start")))
-                continue
-            space_info = block_group.space_info
-            if rec.name == "btrfs_reserve_extent":
-                if record_space(space_info.flags, mixed_bg):
-                    space_history.add_space("Used", rec.ts,
-                                            rec.num_field("len"))
-                space_info.bytes_used += rec.num_field("len")
+                space_info.bytes_may_use += num_bytes
+                space_history.add_space("Reserved", ts, num_bytes)
+                if fs.flush_cycles.waiters:
+                    fs.flush_cycles.reservation(ts, rec.pid, num_bytes,
+                                                "reserved")
             else:
-                if record_space(space_info.flags, mixed_bg):
-                    space_history.remove_space("Used", rec.ts,
-                                               rec.num_field("len"))
-                space_info.bytes_used -= rec.num_field("len")
-        if rec.name == "btrfs_trigger_flush":
-            if rec.str_field("reason") == "enospc":
-                enospc_flushes += 1
+                space_history.remove_space("Reserved", ts, num_bytes)
+                space_info.bytes_may_use -= num_bytes
+        elif "pinned" in reserve_type:
+            space_info = fs.find_space_info(rec.num_field("val"))
+            if reserve == 0:
+                if record_space(space_info.flags, fs.mixed_bg):
+                    space_history.remove_space("Used", ts, num_bytes)
+                space_info.bytes_used -= num_bytes
+        else:
+            if reserve == 1:
+                space_history.add_space(reserve_type, ts, num_bytes)
             else:
-                preempt_flushes += 1
-            flush_events.append([rec.ts, rec.pid, rec.cpu, rec.name, rec.str_field("reason")])
-        if rec.name == "btrfs_flush_space":
-            event_str = flush_event(rec)
-            flush_events.append([rec.ts, rec.pid, rec.cpu, rec.name, event_str])
-
-    print("\nNumber of flushes triggered: enospc = %d, preempt = %d" %
-          (enospc_flushes, preempt_flushes))
-    # If we had a run limit we don't want to do the leak detection as it will be
-    # wrong
-    if run_limit > 0:
-        return
+                space_history.remove_space(reserve_type, ts, num_bytes)
+        if reserve == 1:
+            reservations[reserve_type] = (reservations.get(reserve_type, 0) +
+                                          num_bytes)
+        else:
+            reservations[reserve_type] = (reservations.get(reserve_type, 0) -
+                                          num_bytes)
 
-    num_leaks = 0
-    for space_info in space_infos:
-        if space_info.bytes_may_use != 0:
-            print("Bytes may use leak for space info %d, bytes_may_use %d"  %
-                  (space_info.flags, space_info.bytes_may_use))
-            num_leaks += 1
-    for name,value in reservations.iteritems():
-        if value != 0:
-            print("Reservation for %s outstanding, value %d" % (name, value))
-            num_leaks += 1
+    # For now just ignore btrfs_reserved_extent_alloc because we're not
+    # differentiating between bytes_reserved and bytes_used, we're just
+    # assuming they are the same.
+    def extent(self, rec):
+        fs = self.fs
+        start = rec.num_field("start")
+        block_group = fs.find_block_group(start)
+        if not block_group:
+            print("Huh, didn't find a block group for %d" % (start))
+            return
+        space_info = block_group.space_info
+        length = rec.num_field("len")
+        if rec.name == "btrfs_reserve_extent":
+            if record_space(space_info.flags, fs.mixed_bg):
+                fs.space_history.add_space("Used", rec.ts, length)
+            space_info.bytes_used += length
+            block_group.used += length
+            if block_group.extents:
+                block_group.extents.add(start, length)
+        else:
+            if record_space(space_info.flags, fs.mixed_bg):
+                fs.space_history.remove_space("Used", rec.ts, length)
+            space_info.bytes_used -= length
+            block_group.used -= length
+            if block_group.extents:
+                block_group.extents.remove(start, length)
+        if fs.usage:
+            fs.usage.record(rec.ts, block_group)
 
-    if num_leaks == 0:
-        print("Yay no leaks!")
+    def trigger_flush(self, rec):
+        fs = self.fs
+        reason = rec.str_field("reason")
+        if reason == "enospc":
+            fs.enospc_flushes += 1
+        else:
+            fs.preempt_flushes += 1
+        fs.flush_events.append(FlushEvent(rec.ts, rec.pid, rec.cpu, rec.name,
+                                          reason))
+        fs.flush_cycles.trigger(rec.ts, rec.pid, reason,
+                                rec.num_field("bytes"), fs.bytes_may_use())
 
+    def flush_space(self, rec):
+        fs = self.fs
+        state = rec.num_field("state")
+        fs.flush_events.append(FlushEvent(rec.ts, rec.pid, rec.cpu, rec.name,
+                                          (state, rec.num_field("num_bytes"),
+                                           rec.num_field("orig_bytes"),
+                                           rec.num_field("ret"))))
+        flags = rec.num_field("flags") & (Spaceinfo.BTRFS_BLOCK_GROUP_DATA |
+                                          Spaceinfo.BTRFS_BLOCK_GROUP_METADATA |
+                                          Spaceinfo.BTRFS_BLOCK_GROUP_SYSTEM)
+        fs.flush_cycles.flush_space(rec.ts, rec.pid, state, flags,
+                                    fs.bytes_may_use())
+
+    def failed_cluster_setup(self, rec):
+        self.fs.failed_clusters += 1
+
+    def finish(self):
+        if self.frag_interval:
+            for fs in filesystems.values():
+                fs.sample_fragmentation(self.last_ts)
+        # Report on every filesystem unless we were asked about just one
+        if self.args.fsid:
+            fs = selected_filesystem(self.args)
+            if fs is None:
+                print("\nNo events for fsid %s" % self.args.fsid)
+                return
+            report = [fs]
+        else:
+            report = sorted_filesystems()
+        for fs in report:
+            if len(filesystems) > 1:
+                print("\nFilesystem %s:" % fs.name)
+            self.report(fs)
+            if fs.flush_cycles.triggers:
+                self.report_flush_cycles(fs)
+            if self.frag_interval:
+                self.report_fragmentation(fs)
+
+    def report(self, fs):
+        print("\nNumber of flushes triggered: enospc = %d, preempt = %d" %
+              (fs.enospc_flushes, fs.preempt_flushes))
+        # If we had a run limit or didn't start from the beginning we don't
+        # want to do the leak detection as it will be wrong
+        if self.run_limit > 0 or self.checkpoint:
+            return
+
+        num_leaks = 0
+        for space_info in fs.space_infos:
+            if space_info.bytes_may_use != 0:
+                print("Bytes may use leak for space info %d, bytes_may_use %d"  %
+                      (space_info.flags, space_info.bytes_may_use))
+                num_leaks += 1
+        for name,value in fs.reservations.iteritems():
+            if value != 0:
+                print("Reservation for %s outstanding, value %d" % (name, value))
+                num_leaks += 1
+
+        if num_leaks == 0:
+            print("Yay no leaks!")
+
+    def report_flush_cycles(self, fs, max_tasks=10):
+        cycles = fs.flush_cycles
+        print("\nFlush cycles:")
+        if cycles.untimed_states:
+            print("%d flush states ran with no trigger to time them from" %
+                  cycles.untimed_states)
+        for state in sorted(cycles.state_times.keys()):
+            name = FLUSH_STATES.get(state, "state %d" % state)
+            lines = cycles.state_times[state].report(name, scale=NSECS_IN_SEC)
+            lines.insert(1, "\tReclaimed:\t" +
+                         pretty_size(cycles.reclaimed[state]))
+            for line in lines:
+                print(line)
+        for outcome in ["reserved", "enospc"]:
+            for line in cycles.stalls[outcome].report("Stalls ending " +
+                                                      outcome,
+                                                      scale=NSECS_IN_SEC):
+                print(line)
+        print("Stalls only cover the task that triggered each flush")
+        if cycles.waiters:
+            print("%d tasks still waiting at the end" % len(cycles.waiters))
+        tasks = sorted(cycles.task_stalls.items(), key=lambda t: -t[1][0])
+        if tasks:
+            print("Tasks stalled the longest:")
+        for pid, (stall, waits) in tasks[:max_tasks]:
+            print("\tpid %d: %f seconds over %d waits" %
+                  (pid, float(stall) / NSECS_IN_SEC, waits))
+
+    def report_fragmentation(self, fs):
+        print("\nFree space fragmentation:")
+        if fs.unmapped_groups:
+            print("%d block groups are left out, they either had space in " %
+                  fs.unmapped_groups + "use when they were read in or " +
+                  "were restored from a checkpoint")
+        print("Time\t\tFree extents\tLargest free\tFailed cluster setups")
+        first_ts = checkpoints[0].ts if checkpoints else 0
+        for ts, count, largest, failed in fs.frag_samples:
+            print("%f\t%d\t\t%s\t\t%d" %
+                  (float(ts - first_ts) / NSECS_IN_SEC, count,
+                   pretty_size(largest), failed))
+        for line in fs.free_space.histogram().report("Free extent size",
+                                                     fmt="%d"):
+            print(line)
+
+class Progress:
+    # Prints how far through the trace we are, at most once per interval.
+    # Only every 1024th event even looks at the clock.
+    def __init__(self, total_events, interval=0.25):
+        self.total_events = total_events
+        self.interval = interval
+        self.start_time = time.time()
+        self.next_update = self.start_time
+
+    def update(self, cur_event):
+        if not self.total_events or cur_event & 1023:
+            return
+        now = time.time()
+        if now < self.next_update:
+            return
+        self.next_update = now + self.interval
+        rem = (now - self.start_time) / cur_event
+        rem *= self.total_events - cur_event
+        sys.stdout.write("\r%d - %d seconds remaining" % (cur_event, rem))
+        sys.stdout.flush()
+
+class Profile:
+    # Where the time goes while parsing, turned on with --profile
+    def __init__(self):
+        self.start_time = time.time()
+        self.times = {}
+        self.counts = {}
+
+    def wrap(self, name, handler):
+        self.times[name] = 0.0
+        self.counts[name] = 0
+        def timed(rec):
+            start = time.time()
+            handler(rec)
+            self.times[name] += time.time() - start
+            self.counts[name] += 1
+        return timed
+
+    def report(self, nr_events):
+        elapsed = time.time() - self.start_time
+        print("\nProcessed %d events in %f seconds, %d events/sec" %
+              (nr_events, elapsed, nr_events / max(elapsed, 1e-9)))
+        # ru_maxrss is in kilobytes on linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("Peak RSS: %s" % pretty_size(rss * 1024))
+        handled = 0.0
+        for name in sorted(self.times.keys(), key=lambda n: -self.times[n]):
+            if not self.counts[name]:
+                continue
+            handled += self.times[name]
+            print("%s: %d events, %f seconds, %f usecs/event" %
+                  (name, self.counts[name], self.times[name],
+                   self.times[name] * 1000000 / self.counts[name]))
+        print("Reading, decoding and filtering: %f seconds" %
+              (elapsed - handled))
+
+def account_events(args, events, total_events, checkpoint=None):
+    accounting = SpaceAccounting(args, checkpoint)
+    progress = Progress(total_events)
+    profile = None
+    if args.profile:
+        profile = Profile()
+        accounting.set_profile(profile)
+
+    cur_event = 0
+    for rec in events:
+        if not accounting.handle(rec):
+            break
+        cur_event += 1
+        progress.update(cur_event)
+    events.close()
+    accounting.finish()
+    if profile:
+        profile.report(cur_event)
+    # Whether this covered the whole trace, which is all the cache can hold
+    return accounting.run_limit <= 0 and not checkpoint
+
+
+# The parsed state is saved next to the trace so that opening the same trace
+# again doesn't have to decode every event.  The key is stored first so a stale
+# cache can be rejected without loading the rest of it.
+def cache_path(args):
+    return args.infile + ".spacecache"
+
+def cache_key(args):
+    # Every filesystem is parsed, so the cache is good for any --fsid
+    st = os.stat(args.infile)
+    return (CACHE_VERSION, st.st_size, int(st.st_mtime), args.time,
+            args.fragmentation and args.frag_interval,
+            args.heatmap and args.heatmap_interval)
+
+def load_cache(args, checkpoints_only=False):
+    try:
+        f = open(cache_path(args), "rb")
+    except IOError:
+        return False
+    with f:
+        try:
+            if pickle.load(f) != cache_key(args):
+                return False
+            checkpoints[:] = pickle.load(f)
+            if checkpoints_only:
+                return True
+            state = pickle.load(f)
+        except Exception as e:
+            print("Ignoring unreadable cache %s: %s" % (cache_path(args), e))
+            del checkpoints[:]
+            return False
+    filesystems.clear()
+    for fsid, (fs_state, hists, flush_events, samples,
+               usage) in state.items():
+        fs = Filesystem(fsid, 0)
+        fs.set_state(fs_state)
+        fs.space_history.hists = hists
+        fs.flush_events = flush_events
+        fs.frag_samples = samples
+        fs.usage = usage
+        filesystems[fsid] = fs
+    print("Loaded parsed trace from %s" % cache_path(args))
+    return True
 
-def rescale_cb(window, space_history, ts_start, ts_end):
-    window.liststore.clear()
+def save_cache(args):
+    state = dict((fsid, (fs.get_state(), fs.space_history.hists,
+                         fs.flush_events, fs.frag_samples, fs.usage))
+                 for fsid, fs in filesystems.items())
+    path = cache_path(args)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(cache_key(args), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(checkpoints, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        print("Couldn't write cache %s: %s" % (path, e))
+
+# The checkpoints double as a record of every balance over time, so a leak can
+# be narrowed down to the window between two of them and only that window has
+# to be read again to find the reservations that were never given back.
+def leak_window(fsid, name, leaked):
+    # A balance that leaked never gets back to zero again, so the leak started
+    # in the window after the last checkpoint that saw it there.  That
+    # window holds at least part of the leak, and there's nothing before it
+    # to look at.
+    start = checkpoints[0]
+    end_ts = 0
+    for i, checkpoint in enumerate(checkpoints):
+        value = checkpoint.balances.get(fsid, {}).get(name, 0)
+        if (leaked > 0 and value <= 0) or (leaked < 0 and value >= 0):
+            start = checkpoint
+            end_ts = 0
+            if i + 1 < len(checkpoints):
+                end_ts = checkpoints[i + 1].ts
+    return start, end_ts
+
+def balance_matches(rec, name):
+    reserve_type = rec.str_field("type")
+    if "enospc" in reserve_type:
+        return False
+    if name.startswith("bytes_may_use "):
+        return ("space_info" in reserve_type and
+                rec.num_field("val") == int(name.split()[1]))
+    return reserve_type == name
+
+def attributable(name):
+    # space_info and pinned events are made for the space info's flags, which
+    # says nothing about which reserve a release gives back
+    return not (name.startswith("bytes_may_use ") or "space_info" in name or
+                "pinned" in name)
+
+def replay_leak(args, fsid, name, leaked, start_ts, end_ts):
+    # Pair the reserves and releases of one balance inside the window by the
+    # val they were made for, oldest first.  What is left over, reserves for
+    # a leak and releases for a balance that went negative, is then followed
+    # to the end of the trace, and a val that balances out after all was only
+    # held past the window.  Returns the leftovers of the vals that never
+    # balance, as [ts, pid, val, bytes].
+    reserved = {}
+    released = {}
+    leftover = reserved if leaked > 0 else released
+    following = None
+    cur_fsid = None
+    trace = ftrace.open_trace(args.infile)
+    events = trace_events(args, trace, start_ts)
+    for rec in events:
+        if "fsid" in rec:
+            cur_fsid = binascii.hexlify(rec["fsid"].data).decode("ascii")
+        if (rec.name != "btrfs_space_reservation" or cur_fsid != fsid or
+            not balance_matches(rec, name)):
+            continue
+        val = rec.num_field("val")
+        num_bytes = rec.num_field("bytes")
+        reserve = rec.num_field("reserve") == 1
+        if following is None and end_ts and rec.ts >= end_ts:
+            following = dict((v, sum(r[3] for r in l))
+                             for v, l in leftover.items() if l)
+        if following is not None:
+            # How much of the leftover of each val is still outstanding
+            if val not in following:
+                continue
+            if reserve == (leaked > 0):
+                following[val] += num_bytes
+            else:
+                following[val] -= num_bytes
+            if following[val] <= 0:
+                del following[val]
+                if not following:
+                    break
+            continue
+        if reserve:
+            mine, theirs = reserved, released
+        else:
+            mine, theirs = released, reserved
+        pending = theirs.get(val, [])
+        while num_bytes and pending:
+            used = min(num_bytes, pending[0][3])
+            pending[0][3] -= used
+            num_bytes -= used
+            if pending[0][3] == 0:
+                pending.pop(0)
+        if num_bytes:
+            mine.setdefault(val, []).append([rec.ts, rec.pid, val, num_bytes])
+    events.close()
+    return [r for v, l in leftover.items() for r in l
+            if following is None or v in following]
+
+def find_leaks(args):
+    if not checkpoints:
+        return
+    first_ts = checkpoints[0].ts
+    for fsid, fs in sorted(filesystems.items()):
+        for name, leaked in sorted(fs.balances().items()):
+            if leaked == 0:
+                continue
+            start, end_ts = leak_window(fsid, name, leaked)
+            print("\n%s on %s ended at %d, last back at zero at %f" %
+                  (name, fs.name, leaked,
+                   float(start.ts - first_ts) / NSECS_IN_SEC))
+            if not attributable(name):
+                print("Its events don't say what they were made for, so " +
+                      "they can't be paired up, the leak started in the " +
+                      "window up to %s" %
+                      ("the end of the trace" if not end_ts else "%f" %
+                       (float(end_ts - first_ts) / NSECS_IN_SEC)))
+                continue
+            unmatched = replay_leak(args, fsid, name, leaked, start.ts,
+                                    end_ts)
+            # Over-releases show up as releases with nothing to match
+            if leaked > 0:
+                print("Reserves in that window that are never released:")
+            else:
+                print("Releases in that window with no reserve:")
+            for ts, pid, val, num_bytes in sorted(unmatched):
+                print("\t%f pid %d val %d: %d bytes" %
+                      (float(ts - first_ts) / NSECS_IN_SEC, pid, val,
+                       num_bytes))
+
+def rescale_cb(window, fs, ts_start, ts_end):
     print("ts_start == %ld, ts_end == %ld" % (ts_start, ts_end))
-    for events in flush_events:
-        if ts_start == 0 or events[0] >= ts_start:
-            if ts_end == 0 or events[0] <= ts_end:
-                window.add_flush_event(events)
-    space_history.build_lists(4096, ts_start, ts_end)
+    window.set_flush_range(ts_start, ts_end)
+    # Only ask for as many points as we have pixels to draw them in
+    space_history = fs.space_history
+    width = window.darea.get_allocation().width
+    space_history.build_lists(max(width, 1), ts_start, ts_end)
     for n in space_history.times.keys():
         window.darea.update_datapoints(n, space_history.times[n],
                                        space_history.vals[n])
@@ -440,40 +1531,214 @@ def color_index(index):
                (.5, .5, .5)]
     return colors[index]
 
-def visualize_space(args, space_history):
-    from graphscreen import GraphWindow
+def show_filesystem(window, fs, max_vals, ts_start, ts_end):
+    space_history = fs.space_history
+    space_history.build_lists(max_vals, ts_start, ts_end)
+    window.clear_datapoints()
+    window.set_rescale_cb(rescale_cb, fs)
+    i = 0
+    for n in space_history.times.keys():
+        window.add_datapoints(n, space_history.times[n], space_history.vals[n],
+                              color_index(i))
+        i += 1
+    window.set_flush_events(fs.flush_events, describe_flush_event)
+    window.set_flush_range(ts_start, ts_end)
+
+def show_heatmap(heatmap, fs):
+    usage = fs.usage
+    heatmap.set_title("Block group utilization of %s" % fs.name)
+    heatmap.set_grid(usage.sorted_rows(), usage.start or 0, usage.interval)
+
+def visualize_space(args, ts_start=0, ts_end=0):
+    from graphscreen import GraphWindow, HeatmapWindow
+    fs = selected_filesystem(args)
+    if fs is None:
+        print("No events for fsid %s" % args.fsid)
+        return
     max_vals = 0
     if args.average:
         # A completely arbitrary limit
         max_vals = 4096
-    space_history.build_lists(max_vals)
 
     window = GraphWindow()
-    window.set_rescale_cb(rescale_cb, space_history)
-    i = 0
-    for n in space_history.times.keys():
-        window.add_datapoints(n, space_history.times[n], space_history.vals[n],
-                              color_index(i))
-        i += 1
-    for events in flush_events:
-        window.add_flush_event(events)
+    heatmap = None
+    if fs.usage:
+        heatmap = HeatmapWindow()
+        show_heatmap(heatmap, fs)
+        heatmap.show_all()
+    def switch(window, name):
+        show_filesystem(window, filesystems[name], max_vals, ts_start, ts_end)
+        if heatmap:
+            show_heatmap(heatmap, filesystems[name])
+    window.set_choices([f.name for f in sorted_filesystems()], fs.name,
+                       switch)
+    show_filesystem(window, fs, max_vals, ts_start, ts_end)
     window.main()
 
 def record_events():
-    events = [ "btrfs:btrfs_add_block_group",
-               "btrfs:btrfs_space_reservation",
-               "btrfs:btrfs_reserved_extent_free",
-               "btrfs:btrfs_trigger_flush",
-               "btrfs:btrfs_flush_space",
-               "btrfs:btrfs_reserve_extent",
-             ]
-
     cmd = [ 'trace-cmd', 'record', '-B', 'enospc', '-b', '20480', ]
-    for e in events:
+    for e in TRACE_EVENTS:
         cmd.extend(['-e', e])
     subprocess.call(cmd)
 
-if __name__ == "__main__":
+live_parsers = dict((name, ftrace.parse_fields) for name in EVENT_FIELDS)
+live_parsers["btrfs_space_reservation"] = ftrace.parse_space_reservation
+live_parsers["btrfs_trigger_flush"] = ftrace.parse_trigger_flush
+
+def decode_text_event(ev):
+    # Turn an ftrace.Event parsed with live_parsers into what the accounting
+    # expects from tracecmd
+    fields = {}
+    num_fields, str_fields = EVENT_FIELDS[ev.name]
+    try:
+        for f in num_fields:
+            fields[f] = ftrace.num(ev.fields[f])
+        for f in str_fields:
+            fields[f] = ev.fields[f]
+    except (KeyError, ValueError):
+        return None
+    if ev.fields.get("fsid"):
+        fields["fsid"] = binascii.unhexlify(ev.fields["fsid"].replace("-", ""))
+    return DecodedEvent(ev.ts, ev.pid, ev.cpu, ev.name, fields)
+
+def parse_live_line(line):
+    ev = ftrace.parse_line(line, live_parsers)
+    if ev is None:
+        return None
+    return decode_text_event(ev)
+
+class SpaceAnalyzer:
+    # The space accounting as a btrfs-analyze plugin.  Whatever the other
+    # analyzers are reading, we only ever see our own events.
+    name = "Space accounting"
+
+    def __init__(self, args):
+        self.accounting = SpaceAccounting(args)
+        # Nothing resumes from checkpoints here, so don't pay for them
+        self.accounting.record_checkpoints = False
+        self.parsers = live_parsers
+        self.handlers = dict((name, self.handle) for name in EVENT_FIELDS)
+        self.done = False
+
+    def handle(self, ev):
+        if self.done:
+            return
+        rec = decode_text_event(ev)
+        if rec is not None and not self.accounting.handle(rec):
+            self.done = True
+
+    def report(self):
+        self.accounting.finish()
+
+def live_reader(queue):
+    # Reads and parses the events off the pipe, the accounting is done on the
+    # gtk thread so nothing has to be locked against the drawing.  None marks
+    # the end of the pipe.
+    pipe = open(os.path.join(LIVE_INSTANCE, "trace_pipe"))
+    try:
+        while True:
+            line = pipe.readline()
+            if not line:
+                break
+            ev = parse_live_line(line)
+            if ev:
+                queue.put(ev)
+    finally:
+        queue.put(None)
+        pipe.close()
+
+def refresh_live(window, view, span):
+    # Every filesystem is trimmed to the window, only the one being looked at
+    # is drawn
+    for fs in filesystems.values():
+        cutoff = fs.space_history.latest() - span
+        if cutoff <= 0:
+            continue
+        fs.space_history.trim(cutoff)
+        i = 0
+        while i < len(fs.flush_events) and fs.flush_events[i].ts < cutoff:
+            i += 1
+        window.trim_flush_events(fs.flush_events, i)
+
+    names = [fs.name for fs in sorted_filesystems()]
+    if names != view["names"]:
+        view["names"] = names
+        if view["name"] is None:
+            view["name"] = names[0]
+        window.set_choices(names, view["name"], view["switch"])
+    fs = filesystems.get(view["name"])
+    if fs is None:
+        return
+
+    # Stay zoomed in on whatever the user picked until they zoom back out
+    ts_start, ts_end = view["zoom"]
+    space_history = fs.space_history
+    colors = view["colors"]
+    width = window.darea.get_allocation().width
+    space_history.build_lists(max(width, 1), ts_start, ts_end)
+    for n in space_history.times.keys():
+        if n not in colors:
+            colors[n] = color_index(len(colors) % 13)
+            window.add_datapoints(n, space_history.times[n],
+                                  space_history.vals[n], colors[n])
+        else:
+            window.darea.update_datapoints(n, space_history.times[n],
+                                           space_history.vals[n])
+    window.set_rescale_cb(view["rescale"], fs)
+    window.set_flush_events(fs.flush_events, describe_flush_event)
+    window.set_flush_range(ts_start, ts_end)
+
+def watch_live(args):
+    from gi.repository import GLib
+    from graphscreen import GraphWindow
+
+    cmd = [ 'trace-cmd', 'start', '-B', 'enospc', '-b', '20480', ]
+    for e in TRACE_EVENTS:
+        cmd.extend(['-e', e])
+    subprocess.call(cmd)
+
+    # Bounded so a reader that gets ahead of the accounting leaves the
+    # events in the trace buffer instead of piling them up here
+    events = Queue(LIVE_QUEUE_SIZE)
+    reader = threading.Thread(target=live_reader, args=(events,))
+    reader.daemon = True
+    reader.start()
+    accounting = SpaceAccounting(args)
+    # Nothing resumes from checkpoints here, so don't pay for them
+    accounting.record_checkpoints = False
+
+    window = GraphWindow()
+    span = args.window * NSECS_IN_SEC
+    name = fsid_key(args.fsid) if args.fsid else None
+    view = { "name": name, "names": [], "colors": {}, "zoom": (0, 0),
+             "done": False }
+    def rescale(window, fs, ts_start, ts_end):
+        view["zoom"] = (ts_start, ts_end)
+        refresh_live(window, view, span)
+    view["rescale"] = rescale
+    def switch(window, name):
+        view["name"] = name
+        view["colors"] = {}
+        window.clear_datapoints()
+        refresh_live(window, view, span)
+    view["switch"] = switch
+    def refresh():
+        # Account for whatever came in since the last tick
+        while not view["done"]:
+            try:
+                rec = events.get_nowait()
+            except Empty:
+                break
+            if rec is None or not accounting.handle(rec):
+                view["done"] = True
+                accounting.finish()
+        refresh_live(window, view, span)
+        return True
+    GLib.timeout_add(int(1000 / args.fps), refresh)
+    window.main()
+    subprocess.call(['trace-cmd', 'stop', '-B', 'enospc'])
+
+def make_parser():
     parser = argparse.ArgumentParser(description="Visualizer for space usage "+
                                      "in btrfs during operation.")
     parser.add_argument('-i', '--infile', type=str, default="trace.dat",
@@ -485,18 +1750,98 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--time', type=int,
                         help="Limit the parsing to the given amount of seconds")
     parser.add_argument('-a', '--average', action='store_true',
-                        help="Average a large dataset over its time series")
+                        help="Downsample a large dataset to its min and max " +
+                        "over its time series")
     parser.add_argument('-f', '--fsid', type=str,
-                        help="Specify the fsid we care about in the trace file")
+                        help="Specify the fsid we care about in the trace " +
+                        "file, otherwise the first one is shown.  Every " +
+                        "filesystem is parsed either way.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Decode the per-cpu buffers with this many " +
+                        "worker processes")
+    parser.add_argument('-s', '--start', type=float,
+                        help="Start of the time window to look at, in " +
+                        "seconds from the start of the trace")
+    parser.add_argument('-e', '--end', type=float,
+                        help="End of the time window to look at, in " +
+                        "seconds from the start of the trace")
+    parser.add_argument('--checkpoint-interval', type=int, default=10,
+                        help="Seconds of trace time between saved " +
+                        "checkpoints of the accounting state")
+    parser.add_argument('-l', '--live', action='store_true',
+                        help="Watch the events from the running enospc " +
+                        "instance instead of reading a trace file")
+    parser.add_argument('-w', '--window', type=int, default=60,
+                        help="Seconds of history to keep in live mode")
+    parser.add_argument('--fps', type=int, default=4,
+                        help="How many times a second to redraw in live mode")
+    parser.add_argument('-n', '--nocache', action='store_true',
+                        help="Don't read or write the parsed trace cache")
+    parser.add_argument('-F', '--fragmentation', action='store_true',
+                        help="Keep a map of the extents in each block group " +
+                        "and report how fragmented the free space gets")
+    parser.add_argument('--frag-interval', type=float, default=1.0,
+                        help="Seconds of trace time between fragmentation " +
+                        "samples")
+    parser.add_argument('-H', '--heatmap', action='store_true',
+                        help="Also show the utilization of every block group " +
+                        "over time as a heatmap")
+    parser.add_argument('--heatmap-interval', type=float, default=1.0,
+                        help="Seconds of trace time covered by each column " +
+                        "of the heatmap, doubled whenever it would get wider " +
+                        "than %d columns" % UsageGrid.MAX_COLUMNS)
+    parser.add_argument('-L', '--find-leaks', action='store_true',
+                        help="Narrow every leak down to the window between " +
+                        "two checkpoints and list the reservations in it " +
+                        "that never balanced out")
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help="Report events/sec, peak memory and the time " +
+                        "spent on each type of event")
+    return parser
+
+if __name__ == "__main__":
+    parser = make_parser()
     args = parser.parse_args()
+    if args.time and (args.start or args.end):
+        parser.error("--time can't be combined with --start/--end")
+    if args.live and args.nogtk:
+        parser.error("--live needs the gtk window")
+    if args.find_leaks and (args.time or args.start or args.end or
+                            args.live):
+        parser.error("--find-leaks needs the whole trace")
+    if args.heatmap and (args.live or args.nogtk):
+        parser.error("--heatmap is only drawn for a trace file in the gtk " +
+                     "window")
 
     if args.record:
         record_events()
+    elif args.live:
+        watch_live(args)
     else:
         py_supress_trace_output()
-        space_history = SpaceHistory()
-        if args.nogtk:
-            space_history.enabled = False
-        parse_tracefile(args, space_history)
+        # The leak check is only done while parsing, so don't use the cache
+        # when that is all we were asked for, or when we want to time parsing
+        use_cache = not args.nogtk and not args.nocache and not args.profile
+        if args.start or args.end:
+            # Replay from the checkpoint closest to the window if we have them,
+            # otherwise parse from the start, which records them for next time
+            # as long as there's no --end to stop it short
+            checkpoint = None
+            if (not args.nocache and
+                load_cache(args, checkpoints_only=True)):
+                checkpoint = find_checkpoint(time_window(args)[0])
+            if checkpoint is not None:
+                print("Resuming from checkpoint at %d" % checkpoint.ts)
+                parse_tracefile(args, checkpoint)
+            elif parse_tracefile(args) and use_cache:
+                save_cache(args)
+        elif not use_cache or not load_cache(args):
+            # A parse cut short by --time or --end would pass for the whole
+            # trace the next time around, so only save complete ones
+            if parse_tracefile(args) and use_cache:
+                save_cache(args)
+        if args.find_leaks:
+            find_leaks(args)
         if not args.nogtk:
-            visualize_space(args, space_history)
+            ts_start, ts_end = time_window(args)
+            visualize_space(args, ts_start, ts_end)
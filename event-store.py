@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import argparse
+import numpy as np
+import ftrace
+import eventstore
+from eventstore import histogram
+
+NSECS_IN_SEC = float(ftrace.NSECS_IN_SEC)
+TYPE_NAMES = ["Data", "Metadata", "System"]
+
+def print_lines(lines, prefix=""):
+    for line in lines:
+        print(prefix + line)
+
+def space_report(store, fsid):
+    print("Reservations:")
+    totals = eventstore.reservation_totals(store, fsid)
+    for reserve_type in sorted(totals.keys()):
+        ts, total = totals[reserve_type]
+        print("\t%s: %d events, peak %d bytes, %d bytes at the end" %
+              (reserve_type, len(ts), total.max(), total[-1]))
+    ts, used = eventstore.used_total(store, fsid)
+    if len(ts):
+        print("Used: peak %d bytes, %d bytes at the end" %
+              (used.max(), used[-1]))
+
+def breakdown(title, latency, keys, label="%s"):
+    print(title)
+    for key in np.unique(keys).tolist():
+        print_lines(histogram(latency[keys == key]).report(label % key,
+                                    scale=NSECS_IN_SEC), "\t")
+
+def alloc_report(store):
+    latency, alloc, unmatched, in_flight = eventstore.allocation_latency(store)
+    roots, cpus, lens, flags = [np.asarray(col)[alloc] for col in
+            store.columns("find_free_extent", "root", "cpu", "len", "flags")]
+    types = eventstore.allocation_type(flags)
+    print("Reserves with no allocation:\t%d" % unmatched)
+    print("Still in flight at the end:\t%d" % in_flight)
+    if (types < 0).any():
+        print("Allocations with an unknown type:\t%d" % (types < 0).sum())
+    typed = types >= 0
+    latency, roots, cpus, lens, types = (latency[typed], roots[typed],
+                                         cpus[typed], lens[typed], types[typed])
+    print_lines(histogram(latency).report("Totals", scale=NSECS_IN_SEC))
+    # Types and roots are sorted by name like allocator-timing.py does
+    breakdown("By type:", latency, np.array(TYPE_NAMES)[types])
+    breakdown("By root:", latency,
+              np.array([ftrace.root_name(root) for root in roots.tolist()]))
+    breakdown("By cpu:", latency, cpus, "cpu %d")
+    breakdown("By requested size:", latency, eventstore.size_class(lens),
+              "<= %d bytes")
+
+def cluster_report(store):
+    setups = eventstore.cluster_setups(store)
+    print("Number of setups:\t\t\t\t%d" % len(setups["setup_times"]))
+    print("Total setup time:\t\t\t\t%f" %
+          (setups["setup_times"].sum() / NSECS_IN_SEC))
+    print("Number of failed setups:\t\t\t%d" % len(setups["fail_times"]))
+    print("Number of block groups used:\t\t\t%d" % setups["block_groups"])
+    lines = histogram(setups["sizes"]).report("Cluster size", fmt="%d")
+    lines += histogram(setups["setup_times"]).report("Setup time",
+                                                     scale=NSECS_IN_SEC)
+    lines += histogram(setups["fail_times"]).report("Failed setup time",
+                                                    scale=NSECS_IN_SEC)
+    lines += histogram(setups["setups_per_trans"]).report(
+            "Setups per transaction", fmt="%.2f")
+    print_lines(lines)
+
+REPORTS = { "space": lambda store, args: space_report(store, args.fsid),
+            "alloc": lambda store, args: alloc_report(store),
+            "cluster": lambda store, args: cluster_report(store),
+          }
+
+parser = argparse.ArgumentParser(description="Convert a trace into columnar " +
+                                 "arrays once and run the analyses over those")
+parser.add_argument('infile', metavar='file', help='Trace file to process, ' +
+                    'either ftrace text or a trace.dat')
+parser.add_argument('-r', '--rebuild', action='store_true',
+                    help="Rebuild the event store even if it is up to date")
+parser.add_argument('-a', '--analyses', type=str, default="space,alloc,cluster",
+                    help="Comma separated list of reports to print, out of " +
+                    "space, alloc, cluster")
+parser.add_argument('-f', '--fsid', type=str,
+                    help="Only look at the space of this fsid")
+
+args = parser.parse_args()
+
+names = [name for name in args.analyses.split(",") if name]
+for name in names:
+    if name not in REPORTS:
+        parser.error("Unknown analysis '%s'" % name)
+
+store = eventstore.open_store(args.infile, args.rebuild)
+for name in names:
+    REPORTS[name](store, args)
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,355 @@
+import os
+from array import array
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import numpy as np
+import ftrace
+from histogram import LogHistogram
+
+STORE_VERSION = 1
+
+# For each event, the parser for its text form and the numeric and string
+# fields we keep.  Every event also gets seq (its position in the trace), ts,
+# pid and cpu.  Numbers are stored as int64, strings as codes into a table of
+# the strings seen for that field.
+STORE_EVENTS = {
+    "btrfs_add_block_group": (ftrace.parse_fields,
+                              ["offset", "size", "flags", "bytes_used",
+                               "bytes_super"], ["fsid"]),
+    "btrfs_space_reservation": (ftrace.parse_space_reservation,
+                                ["val", "bytes", "reserve"], ["fsid", "type"]),
+    "btrfs_reserve_extent": (ftrace.parse_fields, ["start", "len"], ["fsid"]),
+    "btrfs_reserved_extent_free": (ftrace.parse_fields, ["start", "len"],
+                                   ["fsid"]),
+    "btrfs_trigger_flush": (ftrace.parse_trigger_flush, [],
+                            ["fsid", "reason"]),
+    "btrfs_flush_space": (ftrace.parse_fields,
+                          ["state", "num_bytes", "orig_bytes", "ret"],
+                          ["fsid"]),
+    "find_free_extent": (ftrace.parse_find_free_extent,
+                         ["len", "root", "flags"], []),
+    "btrfs_find_cluster": (None, [], []),
+    "btrfs_setup_cluster": (ftrace.parse_setup_cluster,
+                            ["block_group", "size"], []),
+    "btrfs_failed_cluster_setup": (None, [], []),
+    "btrfs_transaction_commit": (None, [], []),
+}
+HEADER_COLUMNS = ["seq", "ts", "pid", "cpu"]
+
+# The store is a directory of one .npy file per column next to the trace, plus
+# an index with the key of the trace it was built from and the string tables.
+# The index is written last, so a half written store is never used.
+def store_path(infile):
+    return infile + ".events"
+
+def store_key(infile):
+    st = os.stat(infile)
+    return (STORE_VERSION, st.st_size, int(st.st_mtime))
+
+def column_path(path, name, col):
+    return os.path.join(path, "%s.%s.npy" % (name, col))
+
+def build_store(infile, path):
+    parsers = dict((name, spec[0]) for name, spec in STORE_EVENTS.items())
+    columns = {}
+    for name, (parser, nums, strs) in STORE_EVENTS.items():
+        columns[name] = dict((col, array('l'))
+                             for col in HEADER_COLUMNS + nums + strs)
+    codes = {}
+    seq = 0
+    skipped = 0
+    for ev in ftrace.open_events(infile, parsers):
+        parser, nums, strs = STORE_EVENTS[ev.name]
+        try:
+            vals = [ftrace.num(ev.fields[f]) for f in nums]
+        except (KeyError, ValueError, TypeError):
+            skipped += 1
+            continue
+        cols = columns[ev.name]
+        cols["seq"].append(seq)
+        cols["ts"].append(ev.ts)
+        cols["pid"].append(ev.pid)
+        cols["cpu"].append(ev.cpu)
+        seq += 1
+        for f, val in zip(nums, vals):
+            cols[f].append(val)
+        for f in strs:
+            table = codes.setdefault(f, {})
+            s = ev.fields.get(f) or ""
+            code = table.get(s)
+            if code is None:
+                code = table[s] = len(table)
+            cols[f].append(code)
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, cols in columns.items():
+        for col, vals in cols.items():
+            np.save(column_path(path, name, col),
+                    np.array(vals, dtype=np.int64))
+    tables = {}
+    for f, table in codes.items():
+        strings = [None] * len(table)
+        for s, code in table.items():
+            strings[code] = s
+        tables[f] = strings
+    with open(os.path.join(path, "index"), "wb") as f:
+        pickle.dump(store_key(infile), f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tables, f, pickle.HIGHEST_PROTOCOL)
+    if skipped:
+        print("Skipped %d events with missing fields" % skipped)
+    return seq
+
+class EventStore(object):
+    def __init__(self, path, tables):
+        self.path = path
+        self.tables = tables
+
+    def column(self, name, col):
+        # Memory mapped, so only the pages an analysis touches are read
+        return np.load(column_path(self.path, name, col), mmap_mode="r")
+
+    def columns(self, name, *cols):
+        return [self.column(name, col) for col in cols]
+
+    def strings(self, field):
+        return self.tables.get(field, [])
+
+    def code(self, field, s):
+        try:
+            return self.strings(field).index(s)
+        except ValueError:
+            return -1
+
+def open_store(infile, rebuild=False):
+    path = store_path(infile)
+    index = os.path.join(path, "index")
+    if not rebuild:
+        try:
+            with open(index, "rb") as f:
+                if pickle.load(f) == store_key(infile):
+                    return EventStore(path, pickle.load(f))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass
+    print("Building event store %s" % path)
+    build_store(infile, path)
+    with open(index, "rb") as f:
+        pickle.load(f)
+        return EventStore(path, pickle.load(f))
+
+def histogram(values, sub_bits=5):
+    # The same buckets LogHistogram.record would use, a whole array at a time
+    hist = LogHistogram(sub_bits)
+    values = np.maximum(np.asarray(values, dtype=np.int64), 0)
+    if not len(values):
+        return hist
+    # frexp's exponent is the bit length, exact for anything below 2^53
+    bits = np.frexp(values.astype(np.float64))[1]
+    shift = np.maximum(bits - sub_bits - 1, 0)
+    index = np.where(values < (1 << sub_bits), values,
+                     ((shift + 1) << sub_bits) + (values >> shift) -
+                     (1 << sub_bits))
+    buckets, counts = np.unique(index, return_counts=True)
+    hist.buckets = dict(zip(buckets.tolist(), counts.tolist()))
+    hist.count = len(values)
+    hist.total = int(values.sum())
+    hist.min = int(values.min())
+    hist.max = int(values.max())
+    return hist
+
+def fsid_mask(store, name, fsid):
+    fsids = store.column(name, "fsid")
+    if fsid is None:
+        return np.ones(len(fsids), dtype=bool)
+    return fsids == store.code("fsid", fsid)
+
+def reservation_totals(store, fsid=None):
+    # The running total of every reservation type as it is traced:
+    # {type: (ts, total)}.  space_info and pinned are kept under their own
+    # names, SpaceHistory folds those into Reserved and Used instead.
+    name = "btrfs_space_reservation"
+    ts, types, nbytes, reserve = store.columns(name, "ts", "type", "bytes",
+                                               "reserve")
+    mask = fsid_mask(store, name, fsid)
+    signed = np.where(reserve != 0, nbytes, -nbytes)
+    totals = {}
+    for code, reserve_type in enumerate(store.strings("type")):
+        if "enospc" in reserve_type:
+            continue
+        sel = mask & (types == code)
+        if sel.any():
+            totals[reserve_type] = (ts[sel], np.cumsum(signed[sel]))
+    return totals
+
+def used_total(store, fsid=None):
+    # Bytes used in the metadata block groups over time, from the block
+    # groups as they are read in and the extents reserved and freed in them.
+    # Filesystems often have block groups at the same offsets, so each one's
+    # extents are only looked up in its own block groups.
+    if fsid is None:
+        codes = np.unique(store.column("btrfs_add_block_group",
+                                       "fsid")).tolist()
+    else:
+        codes = [store.code("fsid", fsid)]
+    ts = [np.zeros(0, dtype=np.int64)]
+    deltas = [np.zeros(0, dtype=np.int64)]
+    for code in codes:
+        fs_used(store, code, ts, deltas)
+    ts = np.concatenate(ts)
+    deltas = np.concatenate(deltas)
+    order = np.argsort(ts, kind="mergesort")
+    return ts[order], np.cumsum(deltas[order])
+
+def fs_used(store, code, ts, deltas):
+    # Appends the used space changes of one filesystem to ts and deltas
+    name = "btrfs_add_block_group"
+    mine = store.column(name, "fsid") == code
+    bg_seq, bg_ts, offsets, sizes, flags, used = [
+            np.asarray(col)[mine] for col in
+            store.columns(name, "seq", "ts", "offset", "size", "flags",
+                          "bytes_used")]
+
+    # Like the visualizer's mixed_bg, data only counts once the first mixed
+    # block group has been read in
+    mixed = (((flags & ftrace.BLOCK_GROUP_METADATA) != 0) &
+             ((flags & ftrace.BLOCK_GROUP_DATA) != 0))
+    mixed_seq = bg_seq[mixed][0] if mixed.any() else np.iinfo(np.int64).max
+    def record_space(flags, seq):
+        return (((flags & ftrace.BLOCK_GROUP_METADATA) != 0) |
+                (((flags & ftrace.BLOCK_GROUP_DATA) != 0) &
+                 (seq >= mixed_seq)))
+
+    # Reading in a block group only adds to the used space of metadata ones
+    recorded = (flags & ftrace.BLOCK_GROUP_METADATA) != 0
+    ts.append(bg_ts[recorded])
+    deltas.append(used[recorded])
+
+    # Find the block group each extent lands in, with a zero sized one in
+    # front so there is always something to look at
+    order = np.argsort(offsets, kind="mergesort")
+    starts = np.concatenate([[0], offsets[order]])
+    ends = np.concatenate([[0], starts[1:] + sizes[order]])
+    bg_flags = np.concatenate([[0], flags[order]])
+    for ev, sign in (("btrfs_reserve_extent", 1),
+                     ("btrfs_reserved_extent_free", -1)):
+        mine = store.column(ev, "fsid") == code
+        ext_seq, ext_ts, start, length = [
+                np.asarray(col)[mine] for col in
+                store.columns(ev, "seq", "ts", "start", "len")]
+        pos = np.maximum(np.searchsorted(starts, start, side="right") - 1, 0)
+        hit = ((start < ends[pos]) &
+               record_space(bg_flags[pos], ext_seq))
+        ts.append(ext_ts[hit])
+        deltas.append(sign * length[hit])
+
+    # Releasing pinned bytes takes them back out of the used space
+    name = "btrfs_space_reservation"
+    res_seq, res_ts, types, val, nbytes, reserve, fsids = store.columns(
+            name, "seq", "ts", "type", "val", "bytes", "reserve", "fsid")
+    pinned = [i for i, reserve_type in enumerate(store.strings("type"))
+              if "pinned" in reserve_type]
+    sel = (np.isin(types, pinned) & (reserve == 0) &
+           record_space(val, res_seq) & (fsids == code))
+    ts.append(res_ts[sel])
+    deltas.append(-nbytes[sel])
+
+def size_class(size):
+    # Round up to the next power of two
+    size = np.maximum(np.asarray(size, dtype=np.int64), 1)
+    return np.left_shift(1, np.frexp((size - 1).astype(np.float64))[1])
+
+def allocation_type(flags):
+    # Same precedence as allocator-timing.py, -1 if it isn't any of them
+    return np.where(flags & ftrace.BLOCK_GROUP_METADATA, 1,
+                    np.where(flags & ftrace.BLOCK_GROUP_DATA, 0,
+                             np.where(flags & ftrace.BLOCK_GROUP_SYSTEM, 2,
+                                      -1)))
+
+def allocation_latency(store):
+    # Pairs every btrfs_reserve_extent with the find_free_extent it finishes,
+    # the same way the per-task stacks in allocator-timing.py do, except that
+    # nothing is given up on after --max-age.  On traces with lost events the
+    # stacks can pair differently and there is no abandoned count.  Returns the
+    # latencies of the matched allocations and the index of each one's
+    # find_free_extent, plus how many reserves had nothing to match and how
+    # many allocations never finished.
+    f_seq, f_ts, f_pid, f_cpu = store.columns(
+            "find_free_extent", "seq", "ts", "pid", "cpu")
+    r_seq, r_ts, r_pid, r_cpu = store.columns(
+            "btrfs_reserve_extent", "seq", "ts", "pid", "cpu")
+    n = len(f_seq) + len(r_seq)
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, 0, 0
+
+    seq = np.concatenate([f_seq, r_seq])
+    ts = np.concatenate([f_ts, r_ts])
+    pid = np.concatenate([f_pid, r_pid])
+    cpu = np.concatenate([f_cpu, r_cpu])
+    step = np.concatenate([np.ones(len(f_seq), dtype=np.int64),
+                           -np.ones(len(r_seq), dtype=np.int64)])
+    alloc = np.concatenate([np.arange(len(f_seq)),
+                            -np.ones(len(r_seq), dtype=np.int64)])
+    # The idle tasks all share pid 0 so those go by cpu
+    key = np.where(pid == 0, -(cpu + 1), pid)
+
+    order = np.lexsort((seq, key))
+    key, step, ts, alloc = key[order], step[order], ts[order], alloc[order]
+    group = np.concatenate([[0], np.cumsum(key[1:] != key[:-1])])
+    first = np.concatenate([[True], key[1:] != key[:-1]])
+
+    # The stack depth of each task after each event.  A reserve on an empty
+    # stack is dropped, which makes the depth the running sum reflected at
+    # zero: depth = sum - min(0, lowest sum so far), all per task.
+    total = np.cumsum(step)
+    group_start = np.maximum.accumulate(np.where(first, np.arange(n), 0))
+    running = total - (total - step)[group_start]
+    big = 2 * n + 2
+    lowest = np.minimum.accumulate(running - big * group) + big * group
+    depth = running - np.minimum(lowest, 0)
+    before = np.concatenate([[0], depth[:-1]])
+    before[first] = 0
+
+    starts = step > 0
+    matched = ~starts & (before > 0)
+    unmatched = int((~starts & (before == 0)).sum())
+
+    # A find_free_extent and the reserve that pops it are at the same stack
+    # level, and at any one level they alternate, so sorting by level puts
+    # each start right before its end
+    level = np.where(starts, depth, before)
+    keep = starts | matched
+    idx = np.nonzero(keep)[0]
+    idx = idx[np.lexsort((idx, level[idx], key[idx]))]
+    pair = (starts[idx[:-1]] & ~starts[idx[1:]] &
+            (key[idx[:-1]] == key[idx[1:]]) &
+            (level[idx[:-1]] == level[idx[1:]]))
+    begin = idx[:-1][pair]
+    end = idx[1:][pair]
+    in_flight = int(starts.sum()) - len(begin)
+    return ts[end] - ts[begin], alloc[begin], unmatched, in_flight
+
+def cluster_setups(store):
+    # The setup and failure times measure from the last btrfs_find_cluster,
+    # and setups are counted per transaction at each commit
+    find_seq, find_ts = store.columns("btrfs_find_cluster", "seq", "ts")
+    setup_seq, setup_ts, block_group, size = store.columns(
+            "btrfs_setup_cluster", "seq", "ts", "block_group", "size")
+    fail_seq, fail_ts = store.columns("btrfs_failed_cluster_setup", "seq", "ts")
+    commit_seq = store.column("btrfs_transaction_commit", "seq")
+
+    # Nothing found yet counts from 0, like the loop in cluster-trace.py
+    find_ts = np.concatenate([[0], find_ts])
+    def since_find(seq, ts):
+        return ts - find_ts[np.searchsorted(find_seq, seq)]
+
+    trans = np.searchsorted(commit_seq, setup_seq)
+    per_trans = np.bincount(trans, minlength=len(commit_seq) + 1)
+    return { "setup_times": since_find(setup_seq, setup_ts),
+             "fail_times": since_find(fail_seq, fail_ts),
+             "sizes": np.asarray(size),
+             "block_groups": len(np.unique(block_group)),
+             "setups_per_trans": per_trans[:len(commit_seq)],
+           }
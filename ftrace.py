@@ -0,0 +1,262 @@
+import binascii
+import os
+import re
+import sys
+
+NSECS_IN_SEC = 1000000000
+TRACE_DAT_MAGIC = b"\x17\x08\x44tracing"
+
+# "  comm-pid  (tgid) [cpu] flags  secs.usecs: event_name: body"
+# The tgid and irq flags columns depend on the trace options that were set.
+header_re = re.compile(r"\s*(.+?)-(\d+)\s+(?:\(\s*[\d-]+\)\s+)?\[(\d+)\]\s+" +
+                       r"(?:\S+\s+)?(\d+)\.(\d+): (\w+):\s?(.*)")
+field_re = re.compile(r"(\w+) ?= ?([^,\s]+)")
+
+class Event(object):
+    __slots__ = ("comm", "pid", "cpu", "ts", "name", "fields")
+
+    def __init__(self, comm, pid, cpu, ts, name, fields):
+        self.comm = comm
+        self.pid = pid
+        self.cpu = cpu
+        self.ts = ts
+        self.name = name
+        self.fields = fields
+
+    @property
+    def time(self):
+        return float(self.ts) / NSECS_IN_SEC
+
+    @property
+    def process(self):
+        return "%s-%d" % (self.comm, self.pid)
+
+def num(value):
+    # Numbers are often printed with their decoded name, "4(METADATA)"
+    try:
+        return int(value)
+    except ValueError:
+        return int(value.split("(")[0])
+
+def strip_fsid(body):
+    fsid, sep, rest = body.partition(": ")
+    if len(fsid) == 36 and fsid.count("-") == 4:
+        return fsid, rest
+    return None, body
+
+def parse_fields(body):
+    # Handles both the "key = value, key = value" and "key=value key=value"
+    # styles the btrfs tracepoints print with
+    fsid, body = strip_fsid(body)
+    fields = dict(field_re.findall(body))
+    if fsid is not None:
+        fields["fsid"] = fsid
+    return fields
+
+def parse_space_reservation(body):
+    # "fsid: type: val reserve|release bytes"
+    fsid, sep, rest = body.partition(": ")
+    reserve_type, sep, rest = rest.partition(": ")
+    vals = rest.split()
+    if len(vals) < 3:
+        return None
+    return { "fsid": fsid,
+             "type": reserve_type,
+             "val": int(vals[0]),
+             "reserve": int(vals[1] == "reserve"),
+             "bytes": int(vals[2]),
+           }
+
+def parse_numbers(*names):
+    # parse_fields, with the named fields turned into numbers the same way the
+    # trace.dat reader hands them back
+    def parse(body):
+        fields = parse_fields(body)
+        for name in names:
+            if name in fields:
+                fields[name] = num(fields[name])
+        return fields
+    return parse
+
+parse_find_free_extent = parse_numbers("root", "len", "flags")
+parse_setup_cluster = parse_numbers("block_group", "size")
+
+def parse_trigger_flush(body):
+    # "fsid: reason: flush=... flags=... bytes=..."
+    fsid, body = strip_fsid(body)
+    reason, sep, rest = body.partition(": ")
+    fields = parse_fields(rest)
+    fields["fsid"] = fsid
+    fields["reason"] = reason
+    return fields
+
+def parse_line(line, parsers):
+    m = header_re.match(line)
+    if not m:
+        return None
+    name = m.group(6)
+    if name not in parsers:
+        return None
+    parser = parsers[name]
+    fields = {}
+    if parser is not None:
+        fields = parser(m.group(7))
+        if fields is None:
+            return None
+    frac = m.group(5)
+    ts = int(m.group(4)) * NSECS_IN_SEC + int(frac) * 10 ** (9 - len(frac))
+    return Event(m.group(1), int(m.group(2)), int(m.group(3)), ts, name,
+                 fields)
+
+# parsers maps the event names we want to the function that turns the rest of
+# the line into a dict of fields, or None if the header is all we need.  Lines
+# for any other event are skipped without looking past the header.
+def read_events(infile, parsers):
+    for line in infile:
+        ev = parse_line(line, parsers)
+        if ev is not None:
+            yield ev
+
+BLOCK_GROUP_DATA = (1 << 0)
+BLOCK_GROUP_SYSTEM = (1 << 1)
+BLOCK_GROUP_METADATA = (1 << 2)
+ROOT_NAMES = { 1: "ROOT_TREE", 2: "EXTENT_TREE", 3: "CHUNK_TREE",
+               4: "DEV_TREE", 5: "FS_TREE", 7: "CSUM_TREE", 9: "UUID_TREE",
+               10: "FREE_SPACE_TREE", }
+
+def root_name(root):
+    # Only for printing, roots are passed around as numbers
+    return "%d(%s)" % (root, ROOT_NAMES.get(root, ""))
+
+def format_uuid(data):
+    h = binascii.hexlify(data).decode("ascii")
+    return "%s-%s-%s-%s-%s" % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+# The ways we read a field out of a trace.dat record, chosen so the value looks
+# like what the text parsers hand back for the same field.
+DAT_KINDS = {
+    "num": lambda rec, field: rec.num_field(field),
+    "str": lambda rec, field: rec.str_field(field),
+    "uuid": lambda rec, field: (format_uuid(rec[field].data)
+                                if field in rec else None),
+}
+
+# For each event, the (key, trace.dat field, kind) of the fields we hand back
+DAT_FIELDS = {
+    "btrfs_setup_cluster": [ ("block_group", "bg_objectid", "num"),
+                             ("size", "size", "num") ],
+    "find_free_extent": [ ("root", "root_objectid", "num"),
+                          ("len", "num_bytes", "num"),
+                          ("flags", "flags", "num") ],
+    "btrfs_space_reservation": [ ("fsid", "fsid", "uuid"),
+                                 ("type", "type", "str"),
+                                 ("val", "val", "num"),
+                                 ("reserve", "reserve", "num"),
+                                 ("bytes", "bytes", "num") ],
+    "btrfs_add_block_group": [ ("fsid", "fsid", "uuid"),
+                               ("offset", "offset", "num"),
+                               ("size", "size", "num"),
+                               ("flags", "flags", "num"),
+                               ("bytes_used", "bytes_used", "num"),
+                               ("bytes_super", "bytes_super", "num"),
+                               ("create", "create", "num") ],
+    "btrfs_reserve_extent": [ ("fsid", "fsid", "uuid"),
+                              ("start", "start", "num"),
+                              ("len", "len", "num") ],
+    "btrfs_reserved_extent_free": [ ("fsid", "fsid", "uuid"),
+                                    ("start", "start", "num"),
+                                    ("len", "len", "num") ],
+    "btrfs_trigger_flush": [ ("fsid", "fsid", "uuid"),
+                             ("reason", "reason", "str"),
+                             ("bytes", "bytes", "num") ],
+    "btrfs_flush_space": [ ("fsid", "fsid", "uuid"),
+                           ("state", "state", "num"),
+                           ("flags", "flags", "num"),
+                           ("num_bytes", "num_bytes", "num"),
+                           ("orig_bytes", "orig_bytes", "num"),
+                           ("ret", "ret", "num") ],
+    "btrfs_failed_cluster_setup": [ ("fsid", "fsid", "uuid") ],
+}
+
+def open_trace(infile):
+    from tracecmd import Trace
+    from ctracecmd import tracecmd_buffer_instances
+    from ctracecmd import tracecmd_buffer_instance_handle
+
+    trace = Trace(infile)
+    instances = tracecmd_buffer_instances(trace._handle)
+    if instances != 0:
+        new_handle = tracecmd_buffer_instance_handle(trace._handle, 0)
+        trace._handle = new_handle
+    return trace
+
+def read_tracedat(infile, parsers):
+    trace = open_trace(infile)
+    while True:
+        rec = trace.read_next_event()
+        if rec is None:
+            return
+        if rec.name not in parsers:
+            continue
+        fields = {}
+        for key, field, kind in DAT_FIELDS.get(rec.name, []):
+            fields[key] = DAT_KINDS[kind](rec, field)
+        yield Event(rec.comm, rec.pid, rec.cpu, rec.ts, rec.name, fields)
+
+def open_events(path, parsers):
+    # trace.dat files are read through tracecmd with no text involved,
+    # anything else is taken to be ftrace text output
+    with open(path, "rb") as f:
+        magic = f.read(len(TRACE_DAT_MAGIC))
+    if magic == TRACE_DAT_MAGIC:
+        return read_tracedat(path, parsers)
+    return read_events(open(path, "r"), parsers)
+
+class Pipeline(object):
+    # Runs any number of analyzers off a single pass over the trace.  Each
+    # analyzer has a parsers dict like read_events takes, a handlers dict of
+    # event name to the function that wants those events, and a report().
+    def __init__(self, analyzers):
+        self.analyzers = analyzers
+        self.parsers = {}
+        self.handlers = {}
+        for analyzer in analyzers:
+            for name, parser in analyzer.parsers.items():
+                # A header-only analyzer is happy with whatever fields another
+                # one asked for, but two different parsers can't both win
+                cur = self.parsers.get(name)
+                if cur is None:
+                    self.parsers[name] = parser
+                elif parser is not None and parser is not cur:
+                    raise ValueError("Conflicting parsers for %s" % name)
+            for name, handler in analyzer.handlers.items():
+                self.handlers.setdefault(name, []).append(handler)
+
+    def run(self, path):
+        handlers = self.handlers
+        for ev in open_events(path, self.parsers):
+            for handler in handlers.get(ev.name, ()):
+                handler(ev)
+
+    def report(self):
+        for analyzer in self.analyzers:
+            if len(self.analyzers) > 1:
+                print("\n== %s ==" % analyzer.name)
+            analyzer.report()
+
+def load_script(name):
+    # The analyzer scripts have dashes in their names, so they can't be
+    # imported the normal way
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    modname = os.path.splitext(name)[0].replace("-", "_")
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source(modname, path)
+    spec = spec_from_file_location(modname, path)
+    module = module_from_spec(spec)
+    # Registered like imp.load_source does, so pickle can find its classes
+    sys.modules[modname] = module
+    spec.loader.exec_module(module)
+    return module
@@ -1,8 +1,9 @@
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
-from gi.repository import Gtk,Gdk
+from gi.repository import Gtk,Gdk,GObject
 import cairo
+import struct
 from bisect import bisect_left
 
 NSECS_IN_SEC = 1000000000
@@ -20,11 +21,21 @@ class GraphScreen(Gtk.DrawingArea):
     class DataPoints():
         def __init__(self, name, xpoints, ypoints, color, connected):
             self.name = name
-            self.xpoints = xpoints
-            self.ypoints = ypoints
             self.color = color
             self.connected = connected
             self.enabled = True
+            self.set_points(xpoints, ypoints)
+
+        def set_points(self, xpoints, ypoints):
+            # Work out the bounds once here rather than every time we rescale
+            self.xpoints = xpoints
+            self.ypoints = ypoints
+            if len(xpoints) == 0:
+                return
+            self.xmin = min(xpoints)
+            self.xmax = max(xpoints)
+            self.ymin = min(ypoints)
+            self.ymax = max(ypoints)
 
     def __init__(self):
         Gtk.DrawingArea.__init__(self)
@@ -50,6 +61,11 @@ class GraphScreen(Gtk.DrawingArea):
         self.cur_rescale_x = None
         self.selection_line = None
 
+        # The axes and plots are drawn once into this and reused until the
+        # data, the zoom or our size changes, so redrawing for the selection
+        # line or a tooltip doesn't restroke every point.
+        self.plot_surface = None
+
     def add_datapoints(self, name, xpoints, ypoints, color, connected=True):
         dp = self.DataPoints(name, xpoints, ypoints, color, connected)
         self.plots.append(dp)
@@ -79,22 +95,26 @@ class GraphScreen(Gtk.DrawingArea):
             if len(data.xpoints) == 0:
                 continue
             self.enabled_plots += 1
-            if max(data.xpoints) > self.xmax:
-                self.xmax = max(data.xpoints)
-            if not self.xmin or self.xmin < min(data.xpoints):
-                self.xmin = min(data.xpoints)
-            if max(data.ypoints) > self.ymax:
-                self.ymax = max(data.ypoints)
-            if self.ymin > min(data.ypoints):
-                self.ymin = min(data.ypoints)
+            if data.xmax > self.xmax:
+                self.xmax = data.xmax
+            if self.xmin is None or self.xmin > data.xmin:
+                self.xmin = data.xmin
+            if data.ymax > self.ymax:
+                self.ymax = data.ymax
+            if self.ymin > data.ymin:
+                self.ymin = data.ymin
+        self.plot_surface = None
         self.queue_draw()
 
+    def clear_datapoints(self):
+        self.plots = []
+        self._rescale()
+
     def update_datapoints(self, name, xpoints, ypoints):
         for d in self.plots:
             if d.name != name:
                 continue
-            d.xpoints = xpoints
-            d.ypoints = ypoints
+            d.set_points(xpoints, ypoints)
             break
         self._rescale()
 
@@ -192,13 +212,22 @@ class GraphScreen(Gtk.DrawingArea):
         cr.set_font_size(14)
         if width != self.width or height != self.height:
             self._adjust_graph_values(cr, width, height)
-        cr.set_source_rgb(1, 1, 1)
-        cr.rectangle(0, 0, width, height)
-        cr.fill()
+            self.plot_surface = None
+        if self.plot_surface is None:
+            self.plot_surface = cr.get_target().create_similar(
+                    cairo.CONTENT_COLOR, width, height)
+            pcr = cairo.Context(self.plot_surface)
+            pcr.set_font_size(14)
+            pcr.set_source_rgb(1, 1, 1)
+            pcr.rectangle(0, 0, width, height)
+            pcr.fill()
+
+            self._draw_graph(pcr, width, height)
+            if self.enabled_plots > 0:
+                self._draw_plots(pcr, width, height)
+        cr.set_source_surface(self.plot_surface, 0, 0)
+        cr.paint()
 
-        self._draw_graph(cr, width, height)
-        if self.enabled_plots > 0:
-            self._draw_plots(cr, width, height)
         if self.selection_line is not None:
             self._draw_selection_line(cr, width, height)
 
@@ -227,10 +256,13 @@ class GraphScreen(Gtk.DrawingArea):
         # Get the time position our cursor is currently at
         xval = self._get_xval(widget.get_allocation().width, x)
 
-        index = self._bin_search(xval, self.plots[0].xpoints)
         tipstr = ("Time is %f" % (float(xval) / NSECS_IN_SEC))
         for data in self.plots:
-            if data.enabled:
+            # Zoomed in before a series first changes leaves it no points
+            if data.enabled and data.xpoints:
+                # Downsampled plots don't share their x points, so look each
+                # one up on its own
+                index = self._bin_search(xval, data.xpoints)
                 tipstr += (", %s is %s" %
                             (data.name, self.pretty_size(data.ypoints[index])))
         tooltip.set_text(tipstr)
@@ -272,11 +304,267 @@ class GraphScreen(Gtk.DrawingArea):
             ts_end = 0
         self.rescale_cb(ts_start, ts_end)
 
+class FlushEventModel(GObject.GObject, Gtk.TreeModel):
+    # A list model over a slice of the time sorted events, so nothing is copied
+    # into a ListStore and the value string is only made for rows that the
+    # TreeView actually asks for.  The events are searched in place, so the
+    # list can keep growing in live mode; trimming has to go through trim()
+    # so the view hears about the rows going away.
+    column_types = (GObject.TYPE_UINT64, int, int, str, str)
+
+    def __init__(self, events, describe):
+        GObject.GObject.__init__(self)
+        self.events = events
+        self.describe = describe
+        self.start = 0
+        self.end = 0
+        self.first = None
+        self.last = None
+
+    def _bisect(self, ts, lo, hi, right=False):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_ts = self.events[mid][0]
+            if mid_ts < ts or (right and mid_ts == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_range(self, ts_start, ts_end):
+        start = 0
+        end = len(self.events)
+        if ts_start:
+            start = self._bisect(ts_start, 0, end)
+        if ts_end:
+            end = max(self._bisect(ts_end, 0, end, right=True), start)
+        return start, end
+
+    def _ends(self, start, end):
+        if start == end:
+            return None, None
+        return self.events[start], self.events[end - 1]
+
+    def same_range(self, start, end):
+        # The same rows as we are showing, and not just the same positions
+        # in a list that was trimmed and added to since
+        if (start, end) != (self.start, self.end):
+            return False
+        first, last = self._ends(start, end)
+        return first is self.first and last is self.last
+
+    def set_range(self, start, end):
+        self.start = start
+        self.end = end
+        self.first, self.last = self._ends(start, end)
+
+    def grows_to(self, start, end):
+        # Our rows followed by new ones added at the tail of the list
+        if start != self.start or end <= self.end:
+            return False
+        return self.end == self.start or self.events[self.end - 1] is self.last
+
+    def grow(self, end):
+        while self.end < end:
+            self.end += 1
+            index = len(self) - 1
+            self.row_inserted(Gtk.TreePath([index]), self._iter(index)[1])
+        self.first, self.last = self._ends(self.start, self.end)
+
+    def trim(self, count):
+        # Drop the first count events from the list, deleting whichever of
+        # them we are showing one row at a time from the top
+        while self.start < min(count, self.end):
+            self.start += 1
+            self.row_deleted(Gtk.TreePath([0]))
+        del self.events[:count]
+        self.start = max(self.start - count, 0)
+        self.end = max(self.end - count, self.start)
+        self.first, self.last = self._ends(self.start, self.end)
+
+    def find(self, ts):
+        pos = self._bisect(ts, self.start, self.end)
+        if pos == self.end or self.events[pos][0] != ts:
+            return None
+        return pos - self.start
+
+    def __len__(self):
+        return max(self.end - self.start, 0)
+
+    def _iter(self, index):
+        if index < 0 or index >= len(self):
+            return (False, None)
+        tree_iter = Gtk.TreeIter()
+        tree_iter.user_data = index
+        return (True, tree_iter)
+
+    def do_get_flags(self):
+        # Iters are row numbers, which trimming shifts, so they don't persist
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.column_types)
+
+    def do_get_column_type(self, n):
+        return self.column_types[n]
+
+    def do_get_iter(self, path):
+        return self._iter(path.get_indices()[0])
+
+    def do_get_path(self, tree_iter):
+        return Gtk.TreePath([tree_iter.user_data])
+
+    def do_get_value(self, tree_iter, column):
+        event = self.events[self.start + tree_iter.user_data]
+        if column == 4:
+            return self.describe(event)
+        return event[column]
+
+    def do_iter_next(self, tree_iter):
+        if tree_iter.user_data + 1 >= len(self):
+            return False
+        tree_iter.user_data += 1
+        return True
+
+    def do_iter_children(self, parent):
+        if parent is not None:
+            return (False, None)
+        return self._iter(0)
+
+    def do_iter_has_child(self, tree_iter):
+        return False
+
+    def do_iter_n_children(self, tree_iter):
+        if tree_iter is not None:
+            return 0
+        return len(self)
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is not None:
+            return (False, None)
+        return self._iter(n)
+
+    def do_iter_parent(self, child):
+        return (False, None)
+
+class HeatmapScreen(Gtk.DrawingArea):
+    # One row per block group and one column per interval of time, colored
+    # from blue for empty to red for full.  The cells are turned into an image
+    # once when the grid is set, drawing just scales that to the window.
+    EMPTY = struct.pack("=I", 0xffffff)
+    COLORS = [struct.pack("=I", (i << 16) | (255 - i)) for i in range(256)]
+    # The largest image cairo will make either way
+    MAX_SIZE = 32767
+
+    def __init__(self):
+        Gtk.DrawingArea.__init__(self)
+        self.set_has_tooltip(True)
+        self.connect("draw", self.on_draw)
+        self.connect("query-tooltip", self.tooltip)
+        self.rows = []
+        self.ncols = 0
+        self.start = 0
+        self.interval = 1
+        self.surface = None
+
+    def _color(self, used, size):
+        if used < 0:
+            return self.EMPTY
+        level = min(max(used, 0) * 255 // max(size, 1), 255)
+        return self.COLORS[level]
+
+    def set_grid(self, rows, start, interval):
+        # rows is a list of (offset, size, used bytes at each interval)
+        self.rows = rows
+        self.start = start
+        self.interval = interval
+        self.ncols = max([len(used) for offset, size, used in rows] + [0])
+        self.surface = None
+        if self.ncols:
+            # Past cairo's limit only every rstep'th row and cstep'th column
+            # make it into the image, the tooltip still looks at all of them
+            rstep = (len(rows) + self.MAX_SIZE - 1) // self.MAX_SIZE
+            cstep = (self.ncols + self.MAX_SIZE - 1) // self.MAX_SIZE
+            image = rows[::rstep]
+            width = (self.ncols + cstep - 1) // cstep
+            stride = cairo.ImageSurface.format_stride_for_width(
+                    cairo.FORMAT_RGB24, width)
+            self.data = bytearray(stride * len(image))
+            for y, (offset, size, used) in enumerate(image):
+                line = [self._color(u, size) for u in used]
+                # A row ends at its last change, carry that on to the end
+                line.extend([line[-1]] * (self.ncols - len(line)))
+                self.data[y * stride:y * stride + 4 * width] = \
+                        b"".join(line[::cstep])
+            self.surface = cairo.ImageSurface.create_for_data(
+                    self.data, cairo.FORMAT_RGB24, width, len(image), stride)
+        self.queue_draw()
+
+    def _cell(self, widget, x, y):
+        width = widget.get_allocation().width
+        height = widget.get_allocation().height
+        col = int(x * self.ncols / max(width, 1))
+        row = int(y * len(self.rows) / max(height, 1))
+        if col >= self.ncols or row >= len(self.rows):
+            return None
+        return (row, col)
+
+    def on_draw(self, widget, cr):
+        width = widget.get_allocation().width
+        height = widget.get_allocation().height
+        cr.set_source_rgb(1, 1, 1)
+        cr.rectangle(0, 0, width, height)
+        cr.fill()
+        if self.surface is None:
+            return
+        cr.scale(float(width) / self.surface.get_width(),
+                 float(height) / self.surface.get_height())
+        cr.set_source_surface(self.surface, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_NEAREST)
+        cr.paint()
+
+    def tooltip(self, widget, x, y, keyboard_mode, tooltip):
+        cell = self._cell(widget, x, y)
+        if cell is None:
+            return False
+        offset, size, used = self.rows[cell[0]]
+        col = min(cell[1], len(used) - 1)
+        tipstr = ("Block group %d, time is %f" %
+                  (offset, float(self.start + cell[1] * self.interval) /
+                   NSECS_IN_SEC))
+        if used[col] < 0:
+            tipstr += ", not read in yet"
+        else:
+            tipstr += (", used %d of %d bytes (%d%%)" %
+                       (used[col], size, used[col] * 100 // max(size, 1)))
+        tooltip.set_text(tipstr)
+        return True
+
+class HeatmapWindow(Gtk.Window):
+    def __init__(self):
+        Gtk.Window.__init__(self, title="Btrfs block group utilization")
+        self.set_default_size(1600, 800)
+        self.darea = HeatmapScreen()
+        self.add(self.darea)
+        # The graph window owns the main loop, closing this one just hides it
+        self.connect("delete-event",
+                     lambda window, event: window.hide_on_delete())
+
+    def set_grid(self, rows, start, interval):
+        self.darea.set_grid(rows, start, interval)
+
 class GraphWindow(Gtk.Window):
     def __init__(self):
         Gtk.Window.__init__(self, title="Btrfs space utliziation")
         self.set_default_size(1600, 1200)
         mainbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        # Only shown once there is more than one thing to choose between
+        self.choices = Gtk.ComboBoxText()
+        self.choices.connect("changed", self.choice_changed)
+        self.choices.set_no_show_all(True)
+        self.choice_names = []
+        self.choice_cb = None
+        mainbox.pack_start(self.choices, False, False, 0)
         drawbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         self.labelbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         treebox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
@@ -289,8 +577,11 @@ class GraphWindow(Gtk.Window):
         self.add(mainbox)
 
         scroll = Gtk.ScrolledWindow()
-        self.liststore = Gtk.ListStore(long, int, int, str, str)
-        self.tree = Gtk.TreeView(self.liststore)
+        self.flush_model = None
+        self.tree = Gtk.TreeView()
+        # With fixed row heights the TreeView only asks the model about the
+        # rows it is showing
+        self.tree.set_fixed_height_mode(True)
         self.selection = self.tree.get_selection()
         self.selection.set_mode(Gtk.SelectionMode.SINGLE)
         self.selection.connect("changed", self.selection_changed)
@@ -298,6 +589,9 @@ class GraphWindow(Gtk.Window):
         for i, column_title in enumerate(["Timestamp", "PID", "CPU", "Event", "Value"]):
             renderer = Gtk.CellRendererText()
             column = Gtk.TreeViewColumn(column_title, renderer, text=i)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(150)
+            column.set_resizable(True)
             self.tree.append_column(column)
 
         scroll.set_hexpand(True)
@@ -325,16 +619,67 @@ class GraphWindow(Gtk.Window):
         button.connect("toggled", self.on_button_toggled, name)
         button.set_active(True)
         self.labelbox.pack_start(button, True, False, 0)
+        button.show()
+
+    def clear_datapoints(self):
+        self.darea.clear_datapoints()
+        for button in self.labelbox.get_children():
+            self.labelbox.remove(button)
+
+    def set_choices(self, names, active, choice_cb):
+        # choice_cb(window, name) is only called when the user picks one
+        self.choice_cb = None
+        self.choice_names = list(names)
+        self.choices.remove_all()
+        for name in self.choice_names:
+            self.choices.append_text(name)
+        if active in self.choice_names:
+            self.choices.set_active(self.choice_names.index(active))
+        self.choices.set_visible(len(self.choice_names) > 1)
+        self.choice_cb = choice_cb
+
+    def choice_changed(self, combo):
+        index = combo.get_active()
+        if self.choice_cb is None or index < 0:
+            return
+        self.choice_cb(self, self.choice_names[index])
 
     def on_button_toggled(self, button, name):
         self.darea.toggle_datapoint(name, button.get_active())
 
-    def add_flush_event(self, event):
-        tree_iter = self.liststore.append(event)
-        if event[0] == self.selected_line:
-            print("setting selected iter")
-            self.selection.select_iter(tree_iter)
-        self.tree.set_model(self.liststore)
+    def set_flush_events(self, events, describe):
+        # Live mode hands us the same list every refresh, keep its model
+        if self.flush_model is not None and self.flush_model.events is events:
+            return
+        self.tree.set_model(None)
+        self.flush_model = FlushEventModel(events, describe)
+
+    def trim_flush_events(self, events, count):
+        # Live mode dropping events off the front of the window
+        if self.flush_model is not None and self.flush_model.events is events:
+            self.flush_model.trim(count)
+        else:
+            del events[:count]
+
+    def set_flush_range(self, ts_start, ts_end):
+        start, end = self.flush_model.find_range(ts_start, ts_end)
+        if self.tree.get_model() is self.flush_model:
+            if self.flush_model.same_range(start, end):
+                return
+            # Live mode adding events, the view keeps its place and selection
+            if self.flush_model.grows_to(start, end):
+                self.flush_model.grow(end)
+                return
+        # Anything else, like a zoom, detaches the model while the range
+        # changes and lets the view start over with the new rows
+        self.tree.set_model(None)
+        self.flush_model.set_range(start, end)
+        self.tree.set_model(self.flush_model)
+        if self.selected_line is None:
+            return
+        index = self.flush_model.find(self.selected_line)
+        if index is not None:
+            self.selection.select_path(Gtk.TreePath([index]))
 
     def selection_changed(self, widget):
         model, pathlist = widget.get_selected_rows()
@@ -345,7 +690,6 @@ class GraphWindow(Gtk.Window):
         self.darea.queue_draw()
 
     def main(self):
-        self.tree.set_model(self.liststore)
         self.show_all()
         Gtk.main()
 
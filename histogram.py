@@ -0,0 +1,86 @@
+import math
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+class LogHistogram(object):
+    # Values are bucketed by their power of two, and each power of two is split
+    # into 2^sub_bits linear buckets, so any value is within 1/2^sub_bits of
+    # its bucket and there are never more than 64 << sub_bits buckets no matter
+    # how many values are recorded.  count, total, min and max are exact.
+    def __init__(self, sub_bits=5):
+        self.sub_bits = sub_bits
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < (1 << self.sub_bits):
+            return value
+        shift = value.bit_length() - self.sub_bits - 1
+        return ((shift + 1) << self.sub_bits) + (value >> shift) - \
+                (1 << self.sub_bits)
+
+    def _value(self, index):
+        # The middle of the range of values that end up in this bucket
+        if index < (1 << self.sub_bits):
+            return index
+        shift = (index >> self.sub_bits) - 1
+        mantissa = (index & ((1 << self.sub_bits) - 1)) + (1 << self.sub_bits)
+        return (mantissa << shift) + ((1 << shift) >> 1)
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return float(self.total) / self.count
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return 0
+        target = max(int(math.ceil(self.count * pct / 100.0)), 1)
+        seen = 0
+        for index in sorted(self.buckets.keys()):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def report(self, name, scale=1, fmt="%f"):
+        # scale turns the recorded integers back into the unit we print in,
+        # e.g. nanoseconds to seconds
+        lines = ["%s:" % name,
+                 "\tCount:\t\t%d" % self.count]
+        if self.count == 0:
+            return lines
+        lines.append(("\tTotal:\t\t" + fmt) % (float(self.total) / scale))
+        lines.append(("\tMean:\t\t" + fmt) % (self.mean() / scale))
+        lines.append(("\tMin:\t\t" + fmt) % (float(self.min) / scale))
+        lines.append(("\tMax:\t\t" + fmt) % (float(self.max) / scale))
+        for pct in PERCENTILES:
+            lines.append(("\tp%s:\t\t" + fmt) %
+                         (pct, float(self.percentile(pct)) / scale))
+        return lines
@@ -1,15 +1,56 @@
 #!/usr/bin/python
 
 import argparse
-import re
+import heapq
+import ftrace
+from histogram import LogHistogram
+
+NSECS_IN_SEC = float(ftrace.NSECS_IN_SEC)
+
+class TopHolders:
+    # The n biggest amounts any actor held at once, as a min heap of
+    # [size, ts, key] so a new peak only has to beat the smallest one
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.entries = {}
+
+    def update(self, key, size, ts):
+        if self.n <= 0:
+            return
+        entry = self.entries.get(key)
+        if entry is not None:
+            if size > entry[0]:
+                entry[0] = size
+                entry[1] = ts
+                heapq.heapify(self.heap)
+            return
+        if len(self.heap) < self.n:
+            entry = [size, ts, key]
+            heapq.heappush(self.heap, entry)
+        elif size > self.heap[0][0]:
+            entry = [size, ts, key]
+            del self.entries[heapq.heapreplace(self.heap, entry)[2]]
+        else:
+            return
+        self.entries[key] = entry
+
+    def largest(self):
+        return sorted(self.heap, reverse=True)
 
 class ReservationPool:
-    def __init__(self, name):
+    def __init__(self, name, top_holders=None):
         self.name = name
         self.mydict = {}
         self.pools = 0
         self.over_released = 0
-    def handle_action(self, actor, action, size):
+        self.missing_released = 0
+        # When each actor went from holding nothing to holding something, and
+        # how long it was until it held nothing again in nanoseconds
+        self.taken = {}
+        self.hold_times = LogHistogram()
+        self.top_holders = top_holders
+    def handle_action(self, actor, action, size, ts=0):
         if action == "reserve":
             if size == 0:
                 return 0
@@ -19,23 +60,26 @@ class ReservationPool:
             else:
                 self.pools += 1
                 self.mydict[actor] = size
+                self.taken[actor] = ts
+            if self.top_holders:
+                self.top_holders.update((self.name, actor),
+                                        self.mydict[actor], ts)
         elif action == "release":
             if size == 0:
                 return 0
 #            print("%s: released %d for %s" % (self.name, size, actor))
             if actor in self.mydict:
                 if self.mydict[actor] < size:
-                    print("%s: trying to release %d when we only have %d for %s"
-                            % (self.name, size, self.mydict[actor], actor))
+                    self.over_released += 1
                     return -1
                 else:
                     self.mydict[actor] -= size
                     if self.mydict[actor] == 0:
                         self.pools -= 1
                         del self.mydict[actor]
+                        self.hold_times.record(ts - self.taken.pop(actor))
             else:
-                print("%s: trying to release %d for actor %s who isn't there" %
-                        (self.name, size, actor))
+                self.missing_released += 1
                 return -1
         else:
             print("Unhandled operation")
@@ -43,15 +87,16 @@ class ReservationPool:
         return 0
 
 class Filesystem:
-    def __init__(self, uuid):
+    def __init__(self, uuid, top_holders=None):
         self.uuid = uuid
-        self.transactions = ReservationPool("transaction")
-        self.delayed_items = ReservationPool("delayed_items")
-        self.delayed_inodes = ReservationPool("delayed_inodes")
-        self.delalloc = ReservationPool("delalloc")
-        self.orphan = ReservationPool("orphan")
-        self.ino_cache = ReservationPool("ino_cache")
-        self.space_info = ReservationPool("space_info")
+        self.top_holders = top_holders
+        self.transactions = ReservationPool("transaction", top_holders)
+        self.delayed_items = ReservationPool("delayed_items", top_holders)
+        self.delayed_inodes = ReservationPool("delayed_inodes", top_holders)
+        self.delalloc = ReservationPool("delalloc", top_holders)
+        self.orphan = ReservationPool("orphan", top_holders)
+        self.ino_cache = ReservationPool("ino_cache", top_holders)
+        self.space_info = ReservationPool("space_info", top_holders)
 
         self.types = {"transaction" : self.transactions,
                         "delayed_item" : self.delayed_items,
@@ -61,55 +106,77 @@ class Filesystem:
                         "ino_cache" : self.ino_cache,
                         "space_info" : self.space_info}
 
-parser = argparse.ArgumentParser(description="Detect space leaks")
-parser.add_argument('infile', metavar='file', help='Trace file to process')
-
-args = parser.parse_args()
-
-infile = open(args.infile, "r")
-
-line_re = re.compile(".* (.*): (.*): (.*) (.*) (\d+)")
-other_line_re = re.compile(".* (.*): (.*): (.*) (.*) (\d+) bytes \d+ flags \d+")
-
-fses = {}
-
-failed_size = 0
-for line in infile:
-    m = other_line_re.match(line)
-    if not m:
-        m = line_re.match(line)
-    if not m:
-        print("didn't recognize that")
-        continue
-    if m.group(1) not in fses:
-        print("Creating fs %s" % m.group(1))
-        fses[m.group(1)] = Filesystem(m.group(1))
-    fs = fses[m.group(1)]
-    if m.group(2) not in fs.types:
-        print("Could not find handler for line '%s'" % line)
-        continue
-    myclass = fs.types[m.group(2)]
-    actor = m.group(3)
-    action = m.group(4)
-    size = int(m.group(5))
-    if myclass.handle_action(actor, action, size) == -1:
-        print("Failed on fs %s, line '%s'" % (m.group(1), line.rstrip()))
-        failed_size += size
-
-print("Total failed size: %d bytes" % failed_size)
-
-total = 0
-for name,fs in fses.iteritems():
-    print("Dumping leaked info for %s" % name)
-    for pname, pool in fs.types.iteritems():
-        if pool.pools != 0:
-            print("%s has %d outstanding pools" % (pname, pool.pools))
-            ptotal = 0
-            for actor,size in pool.mydict.iteritems():
-                print("%s: %d" % (actor, size))
-                total += size
-                ptotal += size
-            print("%s leaked %d bytes" % (pname, ptotal))
-
-print("Total leaked: %d bytes" % total)
+class LeakAnalyzer:
+    name = "Space leaks"
+
+    def __init__(self, top=10):
+        self.parsers = { "btrfs_space_reservation":
+                            ftrace.parse_space_reservation }
+        self.handlers = { "btrfs_space_reservation": self.space_reservation }
+        self.fses = {}
+        self.failed_size = 0
+        self.top = top
+
+    def space_reservation(self, ev):
+        fsid = ev.fields["fsid"]
+        if fsid not in self.fses:
+            print("Creating fs %s" % fsid)
+            self.fses[fsid] = Filesystem(fsid, TopHolders(self.top))
+        fs = self.fses[fsid]
+        if ev.fields["type"] not in fs.types:
+            print("Could not find handler for type '%s'" % ev.fields["type"])
+            return
+        myclass = fs.types[ev.fields["type"]]
+        actor = ev.fields["val"]
+        action = "release"
+        if ev.fields["reserve"]:
+            action = "reserve"
+        size = ev.fields["bytes"]
+        if myclass.handle_action(actor, action, size, ev.ts) == -1:
+            self.failed_size += size
+
+    def report(self):
+        print("Total failed size: %d bytes" % self.failed_size)
+
+        total = 0
+        for name,fs in self.fses.iteritems():
+            print("Dumping leaked info for %s" % name)
+            for pname, pool in fs.types.iteritems():
+                if pool.over_released or pool.missing_released:
+                    print("%s failed releases: %d more than was held, %d for "
+                          "actors holding nothing" %
+                          (pname, pool.over_released, pool.missing_released))
+                if pool.pools != 0:
+                    print("%s has %d outstanding pools" % (pname, pool.pools))
+                    ptotal = 0
+                    for actor,size in pool.mydict.iteritems():
+                        print("%s: %d" % (actor, size))
+                        total += size
+                        ptotal += size
+                    print("%s leaked %d bytes" % (pname, ptotal))
+            for pname, pool in fs.types.iteritems():
+                if pool.hold_times.count:
+                    for line in pool.hold_times.report(pname + " hold time",
+                                                       scale=NSECS_IN_SEC):
+                        print(line)
+            print("Largest holders:")
+            for size, ts, (pname, actor) in fs.top_holders.largest():
+                print("\t%s %s: %d bytes at %f" %
+                      (pname, actor, size, ts / NSECS_IN_SEC))
+
+        print("Total leaked: %d bytes" % total)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect space leaks")
+    parser.add_argument('infile', metavar='file', help='Trace file to ' +
+                        'process, either ftrace text or a trace.dat')
+    parser.add_argument('-n', '--top', type=int, default=10,
+                        help="How many of the largest holders to list")
+
+    args = parser.parse_args()
+    if args.top < 0:
+        parser.error("--top can't be negative")
 
+    pipeline = ftrace.Pipeline([LeakAnalyzer(args.top)])
+    pipeline.run(args.infile)
+    pipeline.report()